@@ -0,0 +1,113 @@
+# Copyright (c) 2014, Los Alamos National Security, LLC
+# All rights reserved.
+# 
+# Copyright 2014. Los Alamos National Security, LLC. This software was 
+# produced under U.S. Government contract DE-AC52-06NA25396 for Los Alamos
+# National Laboratory (LANL), which is operated by Los Alamos National 
+# Security, LLC for the U.S. Department of Energy. The U.S. Government has 
+# rights to use, reproduce, and distribute this software.  NEITHER THE 
+# GOVERNMENT NOR LOS ALAMOS NATIONAL SECURITY, LLC MAKES ANY WARRANTY, EXPRESS
+# OR IMPLIED, OR ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If 
+# software is modified to produce derivative works, such modified software 
+# should be clearly marked, so as not to confuse it with the version available
+# from LANL.
+# 
+# Additionally, redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+# · Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# · Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# · Neither the name of Los Alamos National Security, LLC, Los Alamos National
+#   Laboratory, LANL, the U.S. Government, nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY LOS ALAMOS NATIONAL SECURITY, LLC AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOS ALAMOS NATIONAL 
+# SECURITY, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+
+""" shared setup for the benchmark scripts in this directory. Importing this module puts the Matriarch sources on the
+path and, when no configuration file can be found, writes a throwaway one so `matriarch` can be imported anywhere. """
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+WORK_DIR = tempfile.mkdtemp(prefix="matriarch_bench_")
+os.chdir(WORK_DIR)
+
+if not os.path.exists(os.path.expanduser("~/.matriarchrc.json")):
+    machine = subprocess.check_output(["hostname"])[0:2]
+    with open("config.json", "w") as f:
+        json.dump({'machines': [machine], 'deployment': {machine: WORK_DIR}, 'templates': []}, f)
+
+import matriarch
+
+
+class StubTemplate:
+    """ stands in for a scanned template; the benchmarks never deploy anything """
+    def __init__(self, name):
+        self.name = name
+
+    def get_name(self):
+        return self.name
+
+    def get_extract_func_for(self, name):
+        return lambda timeout=None: {}
+
+
+TEMPLATE = StubTemplate("sedov")
+
+
+def template_lookup(name):
+    return TEMPLATE
+
+
+def make_job(jobid, params=None, state="Completed"):
+    """ builds a MatriarchJob that looks like one JobMonitor would have refreshed """
+    info = {'EState': state, 'CompletionCode': 0, 'SubmissionTime': 1400000000,
+            'StartTime': 1400000100, 'CompletionTime': 1400000100 + jobid % 600,
+            'User': 'bench', 'hostname': 'mu-fe1', 'jobid': jobid}
+    if params is None:
+        params = {'NAME': "run" + str(jobid), 'PROBLEM_SIZE': 2000 + 1000 * (jobid % 4),
+                  'NUM_PROCS': 128, 'regression_tag': "reg_test", 'offset': 1400000000 + 86400 * (jobid % 7)}
+    return matriarch.MatriarchJob(params['NAME'], params, jobid, TEMPLATE, info={'moab': info})
+
+
+def make_prerun(i):
+    return {'name': "prerun" + str(i), 'template': "sedov", 'machine': "mu", 'depends': ["xrage_compile"],
+            'data': {'NAME': "prerun" + str(i), 'PROBLEM_SIZE': 2000, 'XRAGE': "@@xrage_compile@@"}}
+
+
+def open_database(subdir, reuse=False, **options):
+    """ starts a Database whose file lives in a fresh directory under WORK_DIR (or in an existing one, with `reuse`) """
+    path = os.path.join(WORK_DIR, subdir)
+    if not reuse:
+        os.makedirs(path)
+    os.chdir(path)
+    db = matriarch.Database(template_lookup, "mu", **options)
+    db.flush()  # make sure the DB thread has opened its file before anyone changes directory again
+    os.chdir(WORK_DIR)
+    return db
+
+
+def cleanup():
+    os.chdir("/")
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
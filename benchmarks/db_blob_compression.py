@@ -0,0 +1,128 @@
+# Copyright (c) 2014, Los Alamos National Security, LLC
+# All rights reserved.
+# 
+# Copyright 2014. Los Alamos National Security, LLC. This software was 
+# produced under U.S. Government contract DE-AC52-06NA25396 for Los Alamos
+# National Laboratory (LANL), which is operated by Los Alamos National 
+# Security, LLC for the U.S. Department of Energy. The U.S. Government has 
+# rights to use, reproduce, and distribute this software.  NEITHER THE 
+# GOVERNMENT NOR LOS ALAMOS NATIONAL SECURITY, LLC MAKES ANY WARRANTY, EXPRESS
+# OR IMPLIED, OR ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If 
+# software is modified to produce derivative works, such modified software 
+# should be clearly marked, so as not to confuse it with the version available
+# from LANL.
+# 
+# Additionally, redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+# · Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# · Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# · Neither the name of Los Alamos National Security, LLC, Los Alamos National
+#   Laboratory, LANL, the U.S. Government, nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY LOS ALAMOS NATIONAL SECURITY, LLC AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOS ALAMOS NATIONAL 
+# SECURITY, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+
+""" measures how much compressing large job data blobs saves, on jobs whose extract script returned a hotspot profile.
+Every job is written as a run several times, the way JobMonitor refreshes it, and then moved to the job table.
+
+usage: python db_blob_compression.py [JOBS] [HOTSPOTS] [REFRESHES] """
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+
+import bench_util
+
+JOBS = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+HOTSPOTS = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+REFRESHES = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+MODES = [("uncompressed", {'compress_threshold': None}),
+         ("compressed", {})]
+
+
+def make_hotspot_job(jobid):
+    """ a finished job with a hotspot list like the ones extract scripts collect from a profiler """
+    rand = random.Random(jobid)
+    job = bench_util.make_job(jobid)
+    params = job.get_params()
+    params['hotspots'] = [{'function': "hydro_sweep_%d" % k, 'file': "src/hydro/sweep_%d.f90" % (k % 40),
+                           'line': rand.randint(1, 4000), 'percent': round(rand.random() * 5, 3),
+                           'calls': rand.randint(1, 10 ** 6)} for k in range(HOTSPOTS)]
+    params['max_memory'] = rand.randint(10 ** 9, 10 ** 11)
+    params['cycles'] = rand.randint(100, 10000)
+    return job
+
+
+def bytes_written():
+    # what this process has written to storage so far, where the kernel reports it
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def file_size(path):
+    return sum(os.path.getsize(p) for p in [path, path + "-wal"] if os.path.exists(p))
+
+
+def run_mode(label, options):
+    db = bench_util.open_database(label, **options)
+    jobs = [make_hotspot_job(i) for i in range(JOBS)]
+
+    written = bytes_written()
+    start = time.time()
+    for r in range(REFRESHES):
+        for j in jobs:
+            db.insert_run(j)
+        db.flush()
+    for j in jobs:
+        db.insert_job(j)
+        db.remove_run(j)
+    db.flush()
+    write_time = time.time() - start
+    if written is not None:
+        written = bytes_written() - written
+
+    start = time.time()
+    db.get_jobs_for_template("sedov")
+    read_time = time.time() - start
+
+    db.close()
+    db.t.join()
+    return write_time, read_time, written, file_size(db.path)
+
+
+def mb(n):
+    return "n/a" if n is None else "%.1f" % (n / 1048576.0)
+
+
+try:
+    print("%d jobs, %d hotspots each, written %d times as runs" % (JOBS, HOTSPOTS, REFRESHES))
+    print("%-14s %10s %10s %14s %10s" % ("mode", "write s", "read s", "MB written", "DB MB"))
+    for label, options in MODES:
+        write_time, read_time, written, size = run_mode(label, options)
+        print("%-14s %10.2f %10.2f %14s %10s" % (label, write_time, read_time, mb(written), mb(size)))
+finally:
+    bench_util.cleanup()
@@ -0,0 +1,105 @@
+# Copyright (c) 2014, Los Alamos National Security, LLC
+# All rights reserved.
+# 
+# Copyright 2014. Los Alamos National Security, LLC. This software was 
+# produced under U.S. Government contract DE-AC52-06NA25396 for Los Alamos
+# National Laboratory (LANL), which is operated by Los Alamos National 
+# Security, LLC for the U.S. Department of Energy. The U.S. Government has 
+# rights to use, reproduce, and distribute this software.  NEITHER THE 
+# GOVERNMENT NOR LOS ALAMOS NATIONAL SECURITY, LLC MAKES ANY WARRANTY, EXPRESS
+# OR IMPLIED, OR ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If 
+# software is modified to produce derivative works, such modified software 
+# should be clearly marked, so as not to confuse it with the version available
+# from LANL.
+# 
+# Additionally, redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+# · Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# · Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# · Neither the name of Los Alamos National Security, LLC, Los Alamos National
+#   Laboratory, LANL, the U.S. Government, nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY LOS ALAMOS NATIONAL SECURITY, LLC AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOS ALAMOS NATIONAL 
+# SECURITY, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+
+""" measures read throughput when several threads scan a template at once, and how long a small monitor-style query
+takes while they do. Runs first with every read going through the DB thread and then with a WAL-mode reader pool.
+Turning jobs back into objects holds the interpreter lock, so scans/s stays about the same in both modes: the pool
+improves the latency of small queries during a scan, not scan throughput.
+
+usage: python db_read_throughput.py [JOBS] [THREADS] """
+
+from __future__ import print_function
+
+import sys
+import time
+import threading
+
+import bench_util
+
+JOBS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+THREADS = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+DURATION = 3.0
+
+MODES = [("db thread", {}),
+         ("reader pool", {'read_pool_size': THREADS})]
+
+
+def run_mode(label, options):
+    db = bench_util.open_database(label.replace(" ", "_"), **options)
+    for i in range(JOBS):
+        db.insert_job(bench_util.make_job(i))
+    db.insert_global("XRAGE", "/usr/projects/xrage/bin/xrage")
+    db.flush()
+
+    counts = [0] * THREADS
+    stop = threading.Event()
+
+    def reader(idx):
+        while not stop.is_set():
+            db.get_jobs_for_template("sedov")
+            counts[idx] += 1
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(THREADS)]
+    for t in threads:
+        t.start()
+
+    latencies = []
+    try:
+        end = time.time() + DURATION
+        while time.time() < end:
+            start = time.time()
+            db.get_global("XRAGE")
+            latencies.append(time.time() - start)
+            time.sleep(0.01)
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+        db.close()
+
+    latencies.sort()
+    return sum(counts) / DURATION, latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000
+
+
+try:
+    print("%d jobs, %d reader threads" % (JOBS, THREADS))
+    print("%-15s %12s %18s %18s" % ("mode", "scans/s", "monitor p50 (ms)", "monitor max (ms)"))
+    for label, options in MODES:
+        print("%-15s %12.1f %18.2f %18.2f" % ((label,) + run_mode(label, options)))
+finally:
+    bench_util.cleanup()
@@ -0,0 +1,82 @@
+# Copyright (c) 2014, Los Alamos National Security, LLC
+# All rights reserved.
+# 
+# Copyright 2014. Los Alamos National Security, LLC. This software was 
+# produced under U.S. Government contract DE-AC52-06NA25396 for Los Alamos
+# National Laboratory (LANL), which is operated by Los Alamos National 
+# Security, LLC for the U.S. Department of Energy. The U.S. Government has 
+# rights to use, reproduce, and distribute this software.  NEITHER THE 
+# GOVERNMENT NOR LOS ALAMOS NATIONAL SECURITY, LLC MAKES ANY WARRANTY, EXPRESS
+# OR IMPLIED, OR ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If 
+# software is modified to produce derivative works, such modified software 
+# should be clearly marked, so as not to confuse it with the version available
+# from LANL.
+# 
+# Additionally, redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+# · Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# · Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# · Neither the name of Los Alamos National Security, LLC, Los Alamos National
+#   Laboratory, LANL, the U.S. Government, nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY LOS ALAMOS NATIONAL SECURITY, LLC AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOS ALAMOS NATIONAL 
+# SECURITY, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+
+""" measures how many rows per second the Database writer thread can commit, with and without group commit, and with
+the database kept in memory to show how much of the cost is the disk.
+
+usage: python db_write_throughput.py [ROWS] """
+
+from __future__ import print_function
+
+import sys
+import time
+
+import bench_util
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+
+MODES = [("one commit per row", {'batch_size': 1, 'flush_deadline': 0}),
+         ("group commit", {}),
+         ("in memory", {'path': ":memory:"})]
+
+
+def run_mode(label, options):
+    db = bench_util.open_database(label.replace(" ", "_"), **options)
+    jobs = [bench_util.make_job(i, state="Running") for i in range(ROWS)]
+    preruns = [bench_util.make_prerun(i) for i in range(ROWS)]
+
+    start = time.time()
+    for p in preruns:
+        db.insert_prerun(p)
+    for j in jobs:
+        db.insert_run(j)
+    db.flush()
+    elapsed = time.time() - start
+
+    stats = db.get_write_stats()
+    db.close()
+    return (2 * ROWS) / elapsed, elapsed, stats['commits']
+
+
+try:
+    print("%-20s %12s %10s %10s" % ("mode", "rows/s", "seconds", "commits"))
+    for label, options in MODES:
+        rate, elapsed, commits = run_mode(label, options)
+        print("%-20s %12.0f %10.2f %10d" % (label, rate, elapsed, commits))
+finally:
+    bench_util.cleanup()
@@ -0,0 +1,125 @@
+# Copyright (c) 2014, Los Alamos National Security, LLC
+# All rights reserved.
+# 
+# Copyright 2014. Los Alamos National Security, LLC. This software was 
+# produced under U.S. Government contract DE-AC52-06NA25396 for Los Alamos
+# National Laboratory (LANL), which is operated by Los Alamos National 
+# Security, LLC for the U.S. Department of Energy. The U.S. Government has 
+# rights to use, reproduce, and distribute this software.  NEITHER THE 
+# GOVERNMENT NOR LOS ALAMOS NATIONAL SECURITY, LLC MAKES ANY WARRANTY, EXPRESS
+# OR IMPLIED, OR ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If 
+# software is modified to produce derivative works, such modified software 
+# should be clearly marked, so as not to confuse it with the version available
+# from LANL.
+# 
+# Additionally, redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+# · Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# · Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# · Neither the name of Los Alamos National Security, LLC, Los Alamos National
+#   Laboratory, LANL, the U.S. Government, nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY LOS ALAMOS NATIONAL SECURITY, LLC AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOS ALAMOS NATIONAL 
+# SECURITY, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+
+""" measures how quickly JobMonitor notices jobs finishing, against the in-process fake scheduler so it can run without
+a cluster. Jobs take between half and one and a half times RUNTIME seconds and share SLOTS job slots; every job is
+timed from the moment the scheduler finished it to the moment its completion callback ran.
+
+usage: python monitor_throughput.py [JOBS] [SLOTS] [RUNTIME] """
+
+from __future__ import print_function
+
+import sys
+import time
+import random
+import threading
+
+import bench_util
+import matriarch
+import schedulers
+
+JOBS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+SLOTS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+RUNTIME = float(sys.argv[3]) if len(sys.argv) > 3 else 2.0
+
+# queued jobs would otherwise only be looked at every few minutes
+matriarch.CHECK_INTERVALS['Idle'] = 2
+
+
+class CountingScheduler(schedulers.FakeScheduler):
+    def __init__(self, *args, **kwargs):
+        schedulers.FakeScheduler.__init__(self, *args, **kwargs)
+        self.queries = 0
+        self.queried = 0
+
+    def query_many(self, job_ids):
+        self.queries += 1
+        self.queried += len(job_ids)
+        return schedulers.FakeScheduler.query_many(self, job_ids)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+try:
+    sched = CountingScheduler(slots=SLOTS)
+    matriarch.SCHEDULER = sched
+    db = bench_util.open_database("monitor")
+    monitor = matriarch.JobMonitor(db)
+
+    lock = threading.Lock()
+    latencies = []
+    finished = threading.Event()
+
+    def completed(job):
+        with lock:
+            latencies.append(time.time() - sched.jobs[job.get_id()].ended)
+            if len(latencies) == JOBS:
+                finished.set()
+
+    rand = random.Random(0)
+    start = time.time()
+    for i in range(JOBS):
+        jobid = sched.submit(None, runtime=RUNTIME * (0.5 + rand.random()))
+        monitor.add_callback_for_job(jobid, completed)
+        params = {'NAME': "run" + str(i), 'PROBLEM_SIZE': 2000}
+        db.insert_run(matriarch.MatriarchJob(params['NAME'], params, jobid, bench_util.TEMPLATE,
+                                             info={'moab': sched.query(jobid)}))
+
+    finished.wait(RUNTIME * 1.5 * JOBS / SLOTS + 60)
+    elapsed = time.time() - start
+    last_end = max(job.ended for job in sched.jobs.values())
+
+    monitor.close()
+    monitor.t.join()
+    db.flush()
+    recorded = len(db.get_jobs(limit=JOBS))
+    db.close()
+    db.t.join()
+
+    print("%d jobs on %d slots, %.1f s each on average" % (JOBS, SLOTS, RUNTIME))
+    print("recorded %d of them in %.1f s (the scheduler finished the last after %.1f s)" % (recorded, elapsed, last_end - start))
+    # leaving out the query each job's initial status came from
+    print("%d status queries covering %d job checks" % (sched.queries - JOBS, sched.queried - JOBS))
+    if latencies:
+        print("seconds from finishing to being noticed: mean %.2f, p50 %.2f, p95 %.2f, max %.2f" %
+              (sum(latencies) / len(latencies), percentile(latencies, 50), percentile(latencies, 95), max(latencies)))
+finally:
+    bench_util.cleanup()
@@ -0,0 +1,338 @@
+# Copyright (c) 2014, Los Alamos National Security, LLC
+# All rights reserved.
+# 
+# Copyright 2014. Los Alamos National Security, LLC. This software was 
+# produced under U.S. Government contract DE-AC52-06NA25396 for Los Alamos
+# National Laboratory (LANL), which is operated by Los Alamos National 
+# Security, LLC for the U.S. Department of Energy. The U.S. Government has 
+# rights to use, reproduce, and distribute this software.  NEITHER THE 
+# GOVERNMENT NOR LOS ALAMOS NATIONAL SECURITY, LLC MAKES ANY WARRANTY, EXPRESS
+# OR IMPLIED, OR ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If 
+# software is modified to produce derivative works, such modified software 
+# should be clearly marked, so as not to confuse it with the version available
+# from LANL.
+# 
+# Additionally, redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+# · Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# · Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# · Neither the name of Los Alamos National Security, LLC, Los Alamos National
+#   Laboratory, LANL, the U.S. Government, nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY LOS ALAMOS NATIONAL SECURITY, LLC AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOS ALAMOS NATIONAL 
+# SECURITY, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+
+""" a per-template columnar copy of completed job results, kept as NumPy .npy files so analysis code can memory-map
+them instead of parsing /api/data JSON. The files are written directly (no NumPy needed on the server), and new jobs
+are appended in place as they complete. """
+
+import os
+import json
+import shutil
+import struct
+import numbers
+import zipfile
+import threading
+import collections
+import util
+
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+# fixed header size, so the row count can be rewritten in place as a column grows
+NPY_HEADER_LEN = 118
+
+# bumped whenever columns would come out differently, so caches built before are rebuilt instead of reused
+FORMAT = 3
+
+# parameters that differ for every job. As categories they would only grow, and jobid already identifies the row
+SKIPPED_COLUMNS = ['NAME']
+
+# struct format, fill value for missing entries
+DTYPES = {'<i8': ('q', 0), '<f8': ('d', float('nan')), '<i4': ('i', -1)}
+
+
+def npy_header(descr, rows):
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, rows)
+    return NPY_MAGIC + struct.pack("<H", NPY_HEADER_LEN) + (header.ljust(NPY_HEADER_LEN - 1) + "\n").encode("latin1")
+
+
+def number_or_none(value):
+    # the same rule as the param table: only numbers and plain decimal strings, so "1234e56" and "nan" are text
+    if isinstance(value, numbers.Number):
+        return float(value)
+    if isinstance(value, basestring) and util.DECIMAL.match(value.strip()):
+        return float(value)
+    return None
+
+
+class ColumnCache:
+    """ stores, for each template, one .npy file per column: `jobid`, `DURATION`, and every scalar parameter. Numeric
+    parameters are float64 (NaN where a job lacks the parameter); text parameters are int32 codes into a list of
+    categories (-1 where missing). Each column's categories are kept in a file of their own, one JSON string per line,
+    so an append only adds the new ones. A parameter is numeric only if every job's value for it is. When a job brings text
+    into a numeric column, append raises ValueError and the template has to be rebuilt """
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.RLock()
+        self.meta = {}
+        self.jobids = {}
+        # template -> {column name: (categories, {category: code})}
+        self.codes = {}
+        self.rebuilding = {}
+
+    def __template_dir(self, template):
+        # template names reach here from URLs, and the directory may be removed with rmtree, so it must be a single
+        # path component directly under root
+        if not template or template in (".", "..") or os.sep in template or (os.altsep and os.altsep in template):
+            raise ValueError("Not a valid template name: " + repr(template))
+
+        path = os.path.join(self.root, template)
+        if os.path.dirname(os.path.realpath(path)) != os.path.realpath(self.root):
+            raise ValueError("Not a valid template name: " + repr(template))
+        return path
+
+    def __load(self, template):
+        # called with lock held
+        if template in self.meta:
+            return self.meta[template]
+
+        path = os.path.join(self.__template_dir(template), "meta.json")
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as f:
+            meta = json.load(f)
+        if meta.get('format') != FORMAT:
+            return None
+
+        ids = set()
+        if meta['rows'] != 0:
+            with open(os.path.join(self.__template_dir(template), meta['columns'][0]['file']), "rb") as f:
+                f.seek(len(npy_header('<i8', 0)))
+                ids = set(struct.unpack("<%dq" % meta['rows'], f.read(8 * meta['rows'])))
+
+        codes = {}
+        for col in meta['columns']:
+            if col['kind'] == 'category':
+                with open(os.path.join(self.__template_dir(template), col['categories'])) as f:
+                    # a line past the last code in use is a category written just before a crash, and harmless
+                    values = [json.loads(line) for line in f]
+                codes[col['name']] = (values, dict((v, i) for i, v in enumerate(values)))
+
+        self.meta[template] = meta
+        self.jobids[template] = ids
+        self.codes[template] = codes
+        return meta
+
+    def __save_meta(self, template, meta):
+        path = os.path.join(self.__template_dir(template), "meta.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.rename(path + ".tmp", path)
+
+    def __add_column(self, template, meta, name, kind):
+        if kind == 'number':
+            col = {'name': name, 'descr': '<f8', 'kind': 'number'}
+        else:
+            col = {'name': name, 'descr': '<i4', 'kind': 'category'}
+            col['categories'] = "c" + str(len(meta['columns'])) + ".categories"
+            open(os.path.join(self.__template_dir(template), col['categories']), "w").close()
+            self.codes[template][name] = ([], {})
+        col['file'] = "c" + str(len(meta['columns'])) + ".npy"
+
+        # earlier rows don't have this parameter
+        fmt, fill = DTYPES[col['descr']]
+        with open(os.path.join(self.__template_dir(template), col['file']), "wb") as f:
+            f.write(npy_header(col['descr'], meta['rows']))
+            f.write(struct.pack("<%d%s" % (meta['rows'], fmt), *([fill] * meta['rows'])))
+
+        meta['columns'].append(col)
+        return col
+
+    def __encode(self, template, col, value):
+        if value is None or isinstance(value, (list, dict)):
+            return DTYPES[col['descr']][1]
+
+        if col['kind'] == 'number':
+            v = number_or_none(value)
+            if v is None:
+                raise ValueError("Column %s holds numbers, but a job has %r for it" % (col['name'], value))
+            return v
+
+        values, codes = self.codes[template][col['name']]
+        value = "%s" % (value,)
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+        return code
+
+    def __append(self, template, meta, rows):
+        # called with lock held. rows are (jobid, duration, params) tuples
+        ids = self.jobids[template]
+        rows = [r for r in rows if r[0] not in ids]
+        if len(rows) == 0:
+            return
+
+        by_name = dict((c['name'], c) for c in meta['columns'])
+
+        # text in a numeric column leaves nothing written. New columns are numeric if all of these rows say so
+        for col in meta['columns']:
+            if col['kind'] == 'number' and col['name'] not in ('jobid', 'DURATION'):
+                for r in rows:
+                    self.__encode(template, col, r[2].get(col['name']))
+
+        kinds = collections.OrderedDict()
+        for jobid, duration, params in rows:
+            for k, v in params.items():
+                if k in by_name or k in SKIPPED_COLUMNS or v is None or isinstance(v, (list, dict)):
+                    continue
+                if number_or_none(v) is None:
+                    kinds[k] = 'category'
+                else:
+                    kinds.setdefault(k, 'number')
+        for k, kind in kinds.items():
+            by_name[k] = self.__add_column(template, meta, k, kind)
+
+        for col in meta['columns']:
+            if col['name'] == 'jobid':
+                values = [r[0] for r in rows]
+            elif col['name'] == 'DURATION':
+                values = [float('nan') if r[1] is None else float(r[1]) for r in rows]
+            else:
+                known = len(self.codes[template][col['name']][0]) if col['kind'] == 'category' else 0
+                values = [self.__encode(template, col, r[2].get(col['name'])) for r in rows]
+                if col['kind'] == 'category':
+                    self.__save_categories(template, col, known)
+
+            fmt, fill = DTYPES[col['descr']]
+            with open(os.path.join(self.__template_dir(template), col['file']), "r+b") as f:
+                f.seek(len(npy_header(col['descr'], 0)) + meta['rows'] * struct.calcsize(fmt))
+                f.write(struct.pack("<%d%s" % (len(values), fmt), *values))
+                f.seek(0)
+                f.write(npy_header(col['descr'], meta['rows'] + len(rows)))
+
+        meta['rows'] += len(rows)
+        ids.update(r[0] for r in rows)
+        self.__save_meta(template, meta)
+
+    def __save_categories(self, template, col, known):
+        # only the categories past the first `known` are new
+        added = self.codes[template][col['name']][0][known:]
+        if added:
+            with open(os.path.join(self.__template_dir(template), col['categories']), "a") as f:
+                f.write("".join(json.dumps(v) + "\n" for v in added))
+
+    def is_built(self, template):
+        with self.lock:
+            return self.__load(template) != None
+
+    def append(self, template, rows):
+        """ adds newly completed jobs to a template's columns. Templates that have not been built yet are skipped;
+        they will pick the jobs up from the database when they are """
+        with self.lock:
+            if template in self.rebuilding:
+                self.rebuilding[template].extend(rows)
+                return
+
+            meta = self.__load(template)
+            if meta == None:
+                return
+            self.__append(template, meta, rows)
+
+    def build(self, template, rows):
+        """ (re)creates a template's columns from an iterable of (jobid, duration, params) rows. Jobs appended while
+        the rows are being read are added afterwards """
+        with self.lock:
+            if template in self.rebuilding:
+                return
+            self.rebuilding[template] = []
+
+        try:
+            rows = list(rows)
+        except:
+            with self.lock:
+                del self.rebuilding[template]
+            raise
+
+        with self.lock:
+            path = self.__template_dir(template)
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+
+            meta = {'format': FORMAT, 'rows': 0, 'columns': [{'name': 'jobid', 'descr': '<i8', 'kind': 'number', 'file': "jobid.npy"},
+                                           {'name': 'DURATION', 'descr': '<f8', 'kind': 'number', 'file': "DURATION.npy"}]}
+            for col in meta['columns']:
+                with open(os.path.join(path, col['file']), "wb") as f:
+                    f.write(npy_header(col['descr'], 0))
+
+            self.meta[template] = meta
+            self.jobids[template] = set()
+            self.codes[template] = {}
+            self.__append(template, meta, rows + self.rebuilding.pop(template))
+            self.__save_meta(template, meta)
+
+    def invalidate(self, template=None):
+        """ throws away the columns for one template (or all of them), so they are rebuilt on their next use """
+        with self.lock:
+            if template:
+                templates = set([template])
+            else:
+                templates = set(self.meta.keys())
+                if os.path.isdir(self.root):
+                    templates.update(os.listdir(self.root))
+
+            for t in templates:
+                self.meta.pop(t, None)
+                self.jobids.pop(t, None)
+                self.codes.pop(t, None)
+                try:
+                    path = self.__template_dir(t)
+                except ValueError:
+                    # not something build could have made, so not ours to remove
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+
+    def columns(self, template):
+        """ returns [(name, path)] for each column of a built template """
+        with self.lock:
+            meta = self.__load(template)
+            if meta == None:
+                return []
+            return [(c['name'], os.path.join(self.__template_dir(template), c['file'])) for c in meta['columns']]
+
+    def categories(self, template, column):
+        with self.lock:
+            meta = self.__load(template)
+            for c in meta['columns'] if meta else []:
+                if c['name'] == column and c['kind'] == 'category':
+                    return list(self.codes[template][column][0])
+            return None
+
+    def write_npz(self, template, f):
+        """ writes the template's columns to `f` as an uncompressed .npz archive, loadable with numpy.load. Text
+        columns hold category codes; their categories are stored as `<name>_categories` string arrays """
+        with self.lock:
+            meta = self.__load(template)
+            with zipfile.ZipFile(f, "w", zipfile.ZIP_STORED) as z:
+                for c in meta['columns'] if meta else []:
+                    z.write(os.path.join(self.__template_dir(template), c['file']), c['name'] + ".npy")
+                    if c['kind'] == 'category':
+                        categories = self.codes[template][c['name']][0]
+                        width = max([len(s) for s in categories] + [1])
+                        data = b"".join(s.encode("utf-32-le").ljust(4 * width, b"\0") for s in categories)
+                        header = npy_header('<U%d' % width, len(categories))
+                        z.writestr(c['name'] + "_categories.npy", header + data)
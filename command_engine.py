@@ -0,0 +1,288 @@
+# Copyright (c) 2014, Los Alamos National Security, LLC
+# All rights reserved.
+# 
+# Copyright 2014. Los Alamos National Security, LLC. This software was 
+# produced under U.S. Government contract DE-AC52-06NA25396 for Los Alamos
+# National Laboratory (LANL), which is operated by Los Alamos National 
+# Security, LLC for the U.S. Department of Energy. The U.S. Government has 
+# rights to use, reproduce, and distribute this software.  NEITHER THE 
+# GOVERNMENT NOR LOS ALAMOS NATIONAL SECURITY, LLC MAKES ANY WARRANTY, EXPRESS
+# OR IMPLIED, OR ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If 
+# software is modified to produce derivative works, such modified software 
+# should be clearly marked, so as not to confuse it with the version available
+# from LANL.
+# 
+# Additionally, redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+# · Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# · Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# · Neither the name of Los Alamos National Security, LLC, Los Alamos National
+#   Laboratory, LANL, the U.S. Government, nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY LOS ALAMOS NATIONAL SECURITY, LLC AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOS ALAMOS NATIONAL 
+# SECURITY, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+
+""" runs external commands (checkjob, deploy and extract scripts) from a single thread that waits on all of their
+output pipes at once, so hundreds of them can be in flight without a thread each. How many run at once is limited per
+machine and per kind of command, and each command can be given a timeout after which it is killed. """
+
+import os
+import fcntl
+import errno
+import select
+import subprocess
+import threading
+import collections
+import time
+import logging
+
+from db_metrics import Histogram
+from util import CommandTimeout
+
+
+class Command:
+    """ a command handed to a CommandEngine. `wait` blocks until it has finished and returns its output, or raises
+    CalledProcessError if it failed and CommandTimeout if it was killed for running too long """
+    def __init__(self, args, kind, machine, cwd, timeout):
+        self.args = args
+        self.kind = kind
+        self.machine = machine
+        self.cwd = cwd
+        self.timeout = timeout
+        self.created = time.time()
+        self.started = None
+        self.deadline = None
+        self.proc = None
+        self.chunks = []
+        self.output = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, output=None, error=None):
+        self.output = output
+        self.error = error
+        self.done.set()
+
+    def wait(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise CommandTimeout("gave up waiting for " + " ".join(self.args))
+        if self.error:
+            raise self.error
+        return self.output
+
+
+class CommandEngine:
+    """ runs at most `per_machine` commands for each machine and at most `limits[kind]` of each kind at a time, in the
+    order they were submitted. A command of a kind listed in `timeouts` is killed after that many seconds unless it
+    was given its own timeout """
+    def __init__(self, per_machine=16, limits=None, timeouts=None):
+        self.per_machine = per_machine
+        self.limits = limits or {}
+        self.timeouts = timeouts or {}
+
+        self.lock = threading.Lock()
+        self.waiting = collections.deque()
+        # the commands whose output is still being read, by pipe, and those that closed it but haven't exited yet
+        self.reading = {}
+        self.exiting = []
+        self.runningByKind = collections.Counter()
+        self.runningByMachine = collections.Counter()
+        self.closed = False
+
+        self.started = collections.Counter()
+        self.failed = collections.Counter()
+        self.timedOut = collections.Counter()
+        self.waits = collections.defaultdict(Histogram)
+        self.durations = collections.defaultdict(Histogram)
+
+        # submit writes to this pipe to wake the engine thread out of select
+        self.wakeRead, self.wakeWrite = os.pipe()
+        for fd in (self.wakeRead, self.wakeWrite):
+            self.__set_nonblocking(fd)
+
+        self.t = threading.Thread(name="command engine", target=self.__run_thread)
+        self.t.start()
+
+    def __set_nonblocking(self, fd):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def __wake(self):
+        try:
+            os.write(self.wakeWrite, b"x")
+        except OSError as e:
+            # the pipe is full, so the engine has wake-ups pending already
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def submit(self, args, kind, machine=None, cwd=None, timeout=None):
+        """ queues `args` to run and returns its Command """
+        if timeout is None:
+            timeout = self.timeouts.get(kind)
+        cmd = Command(args, kind, machine, cwd, timeout)
+        with self.lock:
+            if self.closed:
+                cmd.finish(error=CommandTimeout("the command engine is closed"))
+                return cmd
+            self.waiting.append(cmd)
+        self.__wake()
+        return cmd
+
+    def run(self, args, kind, machine=None, cwd=None, timeout=None):
+        """ runs `args` and returns its output, like subprocess.check_output """
+        return self.submit(args, kind, machine, cwd, timeout).wait()
+
+    def __may_start(self, cmd):
+        # called with lock held
+        if self.runningByKind[cmd.kind] >= self.limits.get(cmd.kind, self.per_machine):
+            return False
+        return self.runningByMachine[cmd.machine] < self.per_machine
+
+    def __start_waiting(self):
+        now = time.time()
+        with self.lock:
+            # each command that starts can fill up its kind or machine for the ones behind it
+            toStart = []
+            stillWaiting = collections.deque()
+            for cmd in self.waiting:
+                if self.__may_start(cmd):
+                    self.runningByKind[cmd.kind] += 1
+                    self.runningByMachine[cmd.machine] += 1
+                    self.started[cmd.kind] += 1
+                    self.waits[cmd.kind].record(now - cmd.created)
+                    toStart.append(cmd)
+                else:
+                    stillWaiting.append(cmd)
+            self.waiting = stillWaiting
+
+        for cmd in toStart:
+            try:
+                # close_fds, so other commands don't hold this one's pipe open
+                cmd.proc = subprocess.Popen(cmd.args, cwd=cmd.cwd, stdout=subprocess.PIPE, close_fds=True)
+            except OSError as e:
+                self.__done(cmd, error=e)
+                continue
+            cmd.started = now
+            cmd.deadline = None if cmd.timeout is None else now + cmd.timeout
+            fd = cmd.proc.stdout.fileno()
+            self.__set_nonblocking(fd)
+            self.reading[fd] = cmd
+
+    def __done(self, cmd, output=None, error=None):
+        with self.lock:
+            self.runningByKind[cmd.kind] -= 1
+            self.runningByMachine[cmd.machine] -= 1
+            if cmd.started is not None:
+                self.durations[cmd.kind].record(time.time() - cmd.started)
+            if isinstance(error, CommandTimeout):
+                self.timedOut[cmd.kind] += 1
+            elif error:
+                self.failed[cmd.kind] += 1
+        cmd.finish(output, error)
+
+    def __reap(self, cmd):
+        """ finishes `cmd` if its process has exited. Returns False if it is still running """
+        if cmd.proc.poll() is None:
+            return False
+        output = b"".join(cmd.chunks)
+        if cmd.proc.returncode != 0:
+            self.__done(cmd, error=subprocess.CalledProcessError(cmd.proc.returncode, cmd.args, output=output))
+        else:
+            self.__done(cmd, output=output)
+        return True
+
+    def __kill_overdue(self, now):
+        for fd, cmd in list(self.reading.items()) + [(None, cmd) for cmd in self.exiting]:
+            if cmd.deadline is None or now < cmd.deadline:
+                continue
+            logging.warning("Killing %s after %s seconds", " ".join(cmd.args), str(cmd.timeout))
+            try:
+                cmd.proc.kill()
+            except OSError:
+                pass
+            cmd.proc.wait()
+            if fd is None:
+                self.exiting.remove(cmd)
+            else:
+                del self.reading[fd]
+                cmd.proc.stdout.close()
+            self.__done(cmd, error=CommandTimeout("%s did not finish within %s seconds" % (" ".join(cmd.args), str(cmd.timeout))))
+
+    def __next_timeout(self, now):
+        deadlines = [cmd.deadline for cmd in list(self.reading.values()) + self.exiting if cmd.deadline is not None]
+        wait = min(deadlines) - now if deadlines else None
+        if self.exiting:
+            # a process that has closed its output is polled until it exits
+            wait = 0.05 if wait is None else min(wait, 0.05)
+        return None if wait is None else max(0.0, wait)
+
+    def __run_thread(self):
+        while True:
+            self.__start_waiting()
+
+            with self.lock:
+                if self.closed and not self.waiting and not self.reading and not self.exiting:
+                    break
+
+            try:
+                readable = select.select([self.wakeRead] + list(self.reading.keys()), [], [], self.__next_timeout(time.time()))[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in readable:
+                if fd == self.wakeRead:
+                    try:
+                        os.read(self.wakeRead, 4096)
+                    except OSError:
+                        pass
+                    continue
+
+                cmd = self.reading[fd]
+                data = os.read(fd, 65536)
+                if data:
+                    cmd.chunks.append(data)
+                    continue
+
+                # end of output: the process has exited, or is about to
+                del self.reading[fd]
+                cmd.proc.stdout.close()
+                if not self.__reap(cmd):
+                    self.exiting.append(cmd)
+
+            self.exiting = [cmd for cmd in self.exiting if not self.__reap(cmd)]
+            self.__kill_overdue(time.time())
+
+        os.close(self.wakeRead)
+        os.close(self.wakeWrite)
+
+    def get_stats(self):
+        """ for each kind of command: how many are waiting and running, how many have been started, failed and timed
+        out, and histograms of how long they waited to start and how long they ran """
+        with self.lock:
+            kinds = set(self.started) | set(cmd.kind for cmd in self.waiting)
+            queued = collections.Counter(cmd.kind for cmd in self.waiting)
+            return dict((kind, {'queued': queued[kind], 'running': self.runningByKind[kind],
+                                'started': self.started[kind], 'failed': self.failed[kind],
+                                'timed_out': self.timedOut[kind], 'wait': self.waits[kind].get_stats(),
+                                'duration': self.durations[kind].get_stats()}) for kind in kinds)
+
+    def close(self):
+        """ stops taking commands. Those already submitted still run """
+        with self.lock:
+            self.closed = True
+        self.__wake()
@@ -0,0 +1,150 @@
+# Copyright (c) 2014, Los Alamos National Security, LLC
+# All rights reserved.
+# 
+# Copyright 2014. Los Alamos National Security, LLC. This software was 
+# produced under U.S. Government contract DE-AC52-06NA25396 for Los Alamos
+# National Laboratory (LANL), which is operated by Los Alamos National 
+# Security, LLC for the U.S. Department of Energy. The U.S. Government has 
+# rights to use, reproduce, and distribute this software.  NEITHER THE 
+# GOVERNMENT NOR LOS ALAMOS NATIONAL SECURITY, LLC MAKES ANY WARRANTY, EXPRESS
+# OR IMPLIED, OR ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If 
+# software is modified to produce derivative works, such modified software 
+# should be clearly marked, so as not to confuse it with the version available
+# from LANL.
+# 
+# Additionally, redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+# · Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# · Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# · Neither the name of Los Alamos National Security, LLC, Los Alamos National
+#   Laboratory, LANL, the U.S. Government, nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY LOS ALAMOS NATIONAL SECURITY, LLC AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOS ALAMOS NATIONAL 
+# SECURITY, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+
+""" a bounded pool of worker threads for the slow part of finishing a job (running its extract script, setting the
+globals it exports and calling its callbacks), so JobMonitor can keep checking on other jobs in the meantime. """
+
+import collections
+import threading
+import time
+import logging
+
+from db_metrics import Histogram
+
+
+class CompletionPool:
+    """ runs tasks on up to `workers` threads. `submit` blocks while `queue_size` tasks are already waiting, which holds
+    up the monitor rather than letting the backlog grow without bound. Each task is given `timeout`, the number of
+    seconds it may run for; it is up to the task to stop in time (extract scripts are killed), and tasks that overrun
+    are counted """
+    def __init__(self, workers=4, timeout=3600, queue_size=1000):
+        self.timeout = timeout
+        self.queue_size = max(1, int(queue_size))
+        self.lock = threading.Condition()
+        self.tasks = collections.deque()
+        # ids of the tasks queued or running
+        self.pending = set()
+        self.closed = False
+
+        self.running = 0
+        self.peakDepth = 0
+        self.done = 0
+        self.failed = 0
+        self.overran = 0
+        self.waits = Histogram()
+        self.durations = Histogram()
+
+        self.threads = []
+        for i in range(max(1, int(workers))):
+            t = threading.Thread(name="completion worker %d" % i, target=self.__worker)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, key, func):
+        """ queues `func(timeout)` to run on a worker. `key` identifies the task while it is pending, see is_pending.
+        Returns False if the pool is closed """
+        with self.lock:
+            while len(self.tasks) >= self.queue_size and not self.closed:
+                self.lock.wait()
+            if self.closed:
+                return False
+
+            self.tasks.append((key, func, time.time()))
+            self.pending.add(key)
+            self.peakDepth = max(self.peakDepth, len(self.tasks))
+            self.lock.notify_all()
+        return True
+
+    def is_pending(self, key):
+        with self.lock:
+            return key in self.pending
+
+    def __worker(self):
+        while True:
+            with self.lock:
+                while len(self.tasks) == 0 and not self.closed:
+                    self.lock.wait()
+                if self.closed:
+                    return
+                key, func, queued = self.tasks.popleft()
+                self.running += 1
+                # a slot has opened up for a blocked submit
+                self.lock.notify_all()
+
+            start = time.time()
+            ok = True
+            try:
+                func(self.timeout)
+            except Exception as e:
+                ok = False
+                logging.error("Error finishing job %s: %s", str(key), str(e))
+            duration = time.time() - start
+
+            with self.lock:
+                self.running -= 1
+                self.pending.discard(key)
+                self.waits.record(start - queued)
+                self.durations.record(duration)
+                if ok:
+                    self.done += 1
+                else:
+                    self.failed += 1
+                if self.timeout is not None and duration > self.timeout:
+                    self.overran += 1
+                    logging.warning("Finishing job %s took %.1f seconds, more than its %s second limit", str(key),
+                                    duration, str(self.timeout))
+
+    def get_stats(self):
+        """ the current and peak number of queued tasks, how many are running, counts of finished, failed and overrun
+        tasks, and histograms of how long tasks waited for a worker and how long they ran """
+        with self.lock:
+            return {'queued': len(self.tasks), 'peak_queued': self.peakDepth, 'running': self.running,
+                    'workers': len(self.threads), 'done': self.done, 'failed': self.failed, 'overran': self.overran,
+                    'wait': self.waits.get_stats(), 'duration': self.durations.get_stats()}
+
+    def close(self):
+        """ stops the workers once they finish the tasks they are running. Queued tasks are dropped; their jobs are
+        still in the run table and are finished when Matriarch next starts """
+        with self.lock:
+            self.closed = True
+            if self.tasks:
+                logging.warning("Dropping %d queued job completions", len(self.tasks))
+            for key, func, queued in self.tasks:
+                self.pending.discard(key)
+            self.tasks.clear()
+            self.lock.notify_all()
@@ -65,3 +65,16 @@ class Config:
 
     def get_template_dirs(self):
         return self.config['templates']
+
+    def get_database_options(self):
+        return self.config.get('database', {})
+
+    def get_monitor_options(self):
+        return self.config.get('monitor', {})
+
+    def get_scheduler_options(self):
+        return self.config.get('scheduler', {})
+
+    def get_command_options(self):
+        # None, rather than empty options, when there is no `commands` section: the command engine is optional
+        return self.config.get('commands')
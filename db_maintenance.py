@@ -0,0 +1,160 @@
+# Copyright (c) 2014, Los Alamos National Security, LLC
+# All rights reserved.
+# 
+# Copyright 2014. Los Alamos National Security, LLC. This software was 
+# produced under U.S. Government contract DE-AC52-06NA25396 for Los Alamos
+# National Laboratory (LANL), which is operated by Los Alamos National 
+# Security, LLC for the U.S. Department of Energy. The U.S. Government has 
+# rights to use, reproduce, and distribute this software.  NEITHER THE 
+# GOVERNMENT NOR LOS ALAMOS NATIONAL SECURITY, LLC MAKES ANY WARRANTY, EXPRESS
+# OR IMPLIED, OR ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If 
+# software is modified to produce derivative works, such modified software 
+# should be clearly marked, so as not to confuse it with the version available
+# from LANL.
+# 
+# Additionally, redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+# · Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# · Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# · Neither the name of Los Alamos National Security, LLC, Los Alamos National
+#   Laboratory, LANL, the U.S. Government, nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY LOS ALAMOS NATIONAL SECURITY, LLC AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOS ALAMOS NATIONAL 
+# SECURITY, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+
+""" housekeeping for matriarch.db, run by the Database thread while it has nothing else to do: giving pages freed by
+deleted rows back to the file system, moving WAL frames into the database file, and refreshing the statistics the
+query planner uses. Each run stops when its time budget is spent or new work arrives. """
+
+import time
+import logging
+
+# ANALYZE reads every index, so it is run far less often than the cheap steps
+ANALYZE_INTERVAL = 86400
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+class Maintenance:
+    """ decides when maintenance is due and runs it on the DB thread's connection. A run is due once `interval`
+    seconds have passed since the last one and the database has been idle for `idle` seconds, but only if it was used
+    at all since the last run. Runs on `schemas` (the main database and any attached ones) and takes at most about
+    `budget` seconds """
+    def __init__(self, schemas, interval=3600, idle=5.0, budget=0.5, vacuum_pages=256):
+        self.schemas = schemas
+        self.interval = interval
+        self.idle = idle
+        self.budget = budget
+        self.vacuum_pages = vacuum_pages
+
+        self.next_run = time.time() + interval
+        self.last_run = 0
+        # the checkpointed frame count SQLite reported for each schema's WAL, which keeps growing until the WAL restarts
+        self.wal_position = {}
+        self.last_analyze = 0
+        self.runs = 0
+        self.pages_reclaimed = 0
+        self.bytes_reclaimed = 0
+        self.frames_checkpointed = 0
+        self.last_report = None
+
+    def is_due(self, last_activity):
+        now = time.time()
+        return now >= self.next_run and now - last_activity >= self.idle and last_activity > self.last_run
+
+    def wake_time(self, last_activity):
+        """ seconds until a run could be due, if nothing else happens in the meantime, or None if none will be """
+        if last_activity <= self.last_run:
+            return None
+        return max(0.0, max(self.next_run, last_activity + self.idle) - time.time())
+
+    def run(self, db, busy):
+        """ runs one round of maintenance. `busy` is called between steps and should return True once other work is
+        waiting, which ends the round early. Returns a report of what was done """
+        start = time.time()
+        self.last_run = start
+        deadline = start + self.budget
+        c = db.cursor()
+        report = {'time': start, 'pages_reclaimed': 0, 'bytes_reclaimed': 0, 'frames_checkpointed': 0,
+                  'analyzed': False, 'complete': True}
+
+        def stop():
+            if time.time() >= deadline or busy():
+                report['complete'] = False
+                return True
+            return False
+
+        for schema in self.schemas:
+            if not stop():
+                self.__vacuum(c, schema, report, stop)
+            if not stop():
+                self.__checkpoint(c, schema, report)
+
+        if time.time() - self.last_analyze >= ANALYZE_INTERVAL and not stop():
+            self.__analyze(c)
+            self.last_analyze = time.time()
+            report['analyzed'] = True
+
+        report['duration'] = time.time() - start
+        self.next_run = time.time() + self.interval
+        self.runs += 1
+        self.pages_reclaimed += report['pages_reclaimed']
+        self.bytes_reclaimed += report['bytes_reclaimed']
+        self.frames_checkpointed += report['frames_checkpointed']
+        self.last_report = report
+
+        logging.info("Database maintenance reclaimed %d pages (%d bytes) and checkpointed %d WAL frames in %.3f seconds%s",
+                     report['pages_reclaimed'], report['bytes_reclaimed'], report['frames_checkpointed'],
+                     report['duration'], "" if report['complete'] else ", stopping early")
+        return report
+
+    def __vacuum(self, c, schema, report, stop):
+        if c.execute("PRAGMA " + schema + ".auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            # only a full VACUUM can switch an existing database over, and that can't be done a bit at a time
+            return
+
+        page_size = c.execute("PRAGMA " + schema + ".page_size").fetchone()[0]
+        free = c.execute("PRAGMA " + schema + ".freelist_count").fetchone()[0]
+        while free > 0:
+            c.execute("PRAGMA " + schema + ".incremental_vacuum(" + str(int(self.vacuum_pages)) + ")").fetchall()
+            remaining = c.execute("PRAGMA " + schema + ".freelist_count").fetchone()[0]
+            report['pages_reclaimed'] += free - remaining
+            report['bytes_reclaimed'] += (free - remaining) * page_size
+            free = remaining
+            if stop():
+                break
+
+    def __checkpoint(self, c, schema, report):
+        if c.execute("PRAGMA " + schema + ".journal_mode").fetchone()[0].lower() != "wal":
+            return
+
+        # PASSIVE never waits on readers; frames they still need are left for the next run
+        busy, frames, checkpointed = c.execute("PRAGMA " + schema + ".wal_checkpoint(PASSIVE)").fetchone()
+        previous = self.wal_position.get(schema, 0)
+        if checkpointed < previous:
+            previous = 0
+        report['frames_checkpointed'] += max(0, checkpointed - previous)
+        self.wal_position[schema] = max(0, checkpointed)
+
+    def __analyze(self, c):
+        # newer SQLite versions can sample instead of reading every row; older ones ignore the pragma
+        c.execute("PRAGMA analysis_limit = 1000").fetchall()
+        c.execute("ANALYZE")
+
+    def get_stats(self):
+        return {'runs': self.runs, 'pages_reclaimed': self.pages_reclaimed, 'bytes_reclaimed': self.bytes_reclaimed,
+                'frames_checkpointed': self.frames_checkpointed, 'last_run': self.last_report}
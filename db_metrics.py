@@ -0,0 +1,139 @@
+# Copyright (c) 2014, Los Alamos National Security, LLC
+# All rights reserved.
+# 
+# Copyright 2014. Los Alamos National Security, LLC. This software was 
+# produced under U.S. Government contract DE-AC52-06NA25396 for Los Alamos
+# National Laboratory (LANL), which is operated by Los Alamos National 
+# Security, LLC for the U.S. Department of Energy. The U.S. Government has 
+# rights to use, reproduce, and distribute this software.  NEITHER THE 
+# GOVERNMENT NOR LOS ALAMOS NATIONAL SECURITY, LLC MAKES ANY WARRANTY, EXPRESS
+# OR IMPLIED, OR ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If 
+# software is modified to produce derivative works, such modified software 
+# should be clearly marked, so as not to confuse it with the version available
+# from LANL.
+# 
+# Additionally, redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+# · Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# · Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# · Neither the name of Los Alamos National Security, LLC, Los Alamos National
+#   Laboratory, LANL, the U.S. Government, nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY LOS ALAMOS NATIONAL SECURITY, LLC AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOS ALAMOS NATIONAL 
+# SECURITY, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+
+""" counters and latency histograms for the Database class, so a slow web interface can be traced to the DB thread,
+to SQLite itself, or to the monitors flooding the queues. Everything is kept in memory and reset on restart. """
+
+import re
+import threading
+
+# upper bounds of the histogram buckets, in milliseconds. Anything slower lands in a final overflow bucket.
+BUCKETS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+def statement_label(sql):
+    # statements are keyed by their text, which never holds values (they are bound), so the set of labels stays small
+    return re.sub(r"\s+", " ", sql).strip().rstrip(";")
+
+
+class Histogram:
+    """ a latency histogram over the fixed BUCKETS_MS bounds. Not thread safe on its own; DatabaseMetrics locks it """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        ms = seconds * 1000.0
+        i = 0
+        while i < len(BUCKETS_MS) and ms > BUCKETS_MS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        """ the upper bound of the bucket holding the p-th percentile, or the largest value seen if that is smaller """
+        if self.count == 0:
+            return None
+
+        target = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target and n != 0:
+                return min(BUCKETS_MS[i], self.max) if i < len(BUCKETS_MS) else self.max
+        return self.max
+
+    def get_stats(self):
+        return {'count': self.count,
+                'mean_ms': self.total / self.count if self.count else None,
+                'max_ms': self.max if self.count else None,
+                'p50_ms': self.percentile(50), 'p95_ms': self.percentile(95), 'p99_ms': self.percentile(99),
+                'buckets': [[bound, n] for bound, n in zip(BUCKETS_MS + [None], self.counts) if n != 0]}
+
+
+class DatabaseMetrics:
+    """ what the Database records about itself: the deepest each queue has been when the DB thread picked up its work,
+    how long requests waited in each queue, how long they took from being queued to being answered, how long each
+    statement took to run, and how long commits took """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.peaks = {}
+        self.waits = {}
+        self.latencies = {}
+        self.statements = {}
+        self.commits = Histogram()
+
+    def __histogram(self, table, key):
+        if key not in table:
+            table[key] = Histogram()
+        return table[key]
+
+    def record_depth(self, queue, depth):
+        with self.lock:
+            self.peaks[queue] = max(self.peaks.get(queue, 0), depth)
+
+    def record_wait(self, queue, seconds):
+        with self.lock:
+            self.__histogram(self.waits, queue).record(seconds)
+
+    def record_latency(self, queue, seconds):
+        with self.lock:
+            self.__histogram(self.latencies, queue).record(seconds)
+
+    def record_statement(self, label, seconds):
+        with self.lock:
+            self.__histogram(self.statements, label).record(seconds)
+
+    def record_commit(self, seconds):
+        with self.lock:
+            self.commits.record(seconds)
+
+    def get_stats(self, depths):
+        """ a JSON friendly snapshot. `depths` holds the current length of each queue """
+        with self.lock:
+            queues = dict((q, {'depth': depths.get(q, 0), 'peak': self.peaks.get(q, 0)})
+                          for q in set(depths) | set(self.peaks))
+            return {'queues': queues,
+                    'wait': dict((q, h.get_stats()) for q, h in self.waits.items()),
+                    'latency': dict((q, h.get_stats()) for q, h in self.latencies.items()),
+                    'statements': dict((s, h.get_stats()) for s, h in self.statements.items()),
+                    'commit': self.commits.get_stats()}
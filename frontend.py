@@ -38,9 +38,11 @@
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import matriarch
-from bottle import route, run, static_file, view, request, redirect, auth_basic
+from bottle import route, run, static_file, view, request, response, redirect, abort, auth_basic
 import os
 import json
+import tempfile
+import itertools
 
 
 def check(user, password):
@@ -51,6 +53,7 @@ import argparse
 
 parser = argparse.ArgumentParser("Run a web frontend for Matriarch")
 parser.add_argument('--port', metavar='P', type=int, help="The port to listen on (defaults to 8081)", default=8081)
+parser.add_argument('--server', metavar='S', help="The bottle server adapter to use, e.g. paste or cherrypy for a multi-threaded server (defaults to wsgiref)", default='wsgiref')
 
 args = parser.parse_args()
 
@@ -60,7 +63,10 @@ with matriarch.MatriarchBackend() as mb:
     @view('index')
     @auth_basic(check, realm="This system may contain controlled data. Do not access this system without a NTK.")
     def index():
-        return {'jobs': mb.get_jobs()}
+        jobs = mb.get_job_summaries()
+        if jobs is None:
+            abort(503, "The database is busy, try again later")
+        return {'jobs': jobs}
 
     @route("/submit")
     @view('submit')
@@ -120,10 +126,118 @@ with matriarch.MatriarchBackend() as mb:
             mb.submit_job(tmpl, request.json['NAME'], request.json, depends_on=deps)
         return "Job submitted"
 
+    @route("/api/submit_batch", method='POST')
+    def api_submit_batch():
+        # a whole sweep at once: a JSON array of jobs like the ones /api/submit takes, or one job per line with
+        # Content-Type: application/x-ndjson. Every job is committed in the same transaction, and the response is the
+        # list of their prerun ids.
+        try:
+            if request.content_type.split(';')[0] == 'application/x-ndjson':
+                jobs = [json.loads(line) for line in request.body if line.strip()]
+            else:
+                jobs = json.load(request.body)
+        except ValueError:
+            abort(400, "The request body is not valid JSON")
+
+        if not isinstance(jobs, list) or not all(isinstance(j, dict) and 'template' in j and 'NAME' in j for j in jobs):
+            abort(400, "Expected a list of jobs, each with a template and a NAME")
+
+        response.content_type = 'application/json'
+        try:
+            ids = mb.submit_jobs(jobs)
+        except matriarch.DatabaseTimeout:
+            # the batch is still queued and will be committed as a whole, only later than we were willing to wait
+            response.status = 202
+            return json.dumps({'queued': len(jobs), 'message': "The batch is queued and will be committed, but its ids "
+                               "were not available in time"})
+        return json.dumps(ids)
+
+    def count_arg(value, name, minimum=0):
+        # a paging argument from the query string: None when it is missing, otherwise a whole number of at least
+        # `minimum`
+        if not value:
+            return None
+        try:
+            value = int(value)
+        except ValueError:
+            value = minimum - 1
+        if value < minimum:
+            abort(400, "?" + name + "= must be a whole number of at least " + str(minimum))
+        return value
+
+    @route("/api/jobs")
+    def api_jobs():
+        # one page of job summaries, newest first, with running jobs on the first page. Pass the last jobid of a page
+        # as ?after_id= to get the next one.
+        after_id = count_arg(request.query.get('after_id'), 'after_id')
+        limit = count_arg(request.query.get('limit'), 'limit', minimum=1)
+        jobs = mb.get_job_summaries(limit=100 if limit is None else limit, after_id=after_id)
+        if jobs is None:
+            abort(503, "The database is busy, try again later")
+        return json.dumps([{'jobid': j.get_id(), 'name': j.get_name(), 'template': j.get_template_name(),
+                            'state': j.get_state(), 'hostname': j.get_hostname()} for j in jobs])
+
+    @route("/api/metrics")
+    def api_metrics():
+        # queue depths, wait times and statement latencies from the database thread, and the same for job completions
+        # and external commands
+        response.content_type = 'application/json'
+        metrics = mb.get_db_metrics()
+        metrics['completion'] = mb.get_completion_stats()
+        metrics['commands'] = mb.get_command_stats()
+        return json.dumps(metrics)
+
+    def stream_json(items, ndjson=False):
+        # yields `items` as a JSON array (or as newline delimited JSON) a few hundred at a time, so a response never
+        # has to be built in memory all at once
+        if not ndjson:
+            yield "["
+        buf = []
+        first = True
+        for i in items:
+            if ndjson:
+                buf.append(json.dumps(i) + "\n")
+            else:
+                buf.append(("" if first else ",") + json.dumps(i))
+            first = False
+            if len(buf) == 256:
+                yield "".join(buf)
+                buf = []
+        yield "".join(buf)
+        if not ndjson:
+            yield "]"
+
     @route("/api/data/<template>")
     def api_data(template):
-        jobs = mb.get_jobs_for_template(template)
-        jobs = filter(lambda x: x.is_complete() and not x.has_error(), jobs)
+        # ?param.<name>=<value> arguments filter on job parameters, e.g. /api/data/sedov?param.regression_tag=reg_test.
+        # Other arguments that aren't listed below (such as a cache-busting ?_=) are ignored
+        params = dict((k[len("param."):], v) for k, v in request.query.items() if k.startswith("param."))
+
+        # ?limit=N returns one page of jobs, oldest first. When there may be more, the X-Next-After-Id header holds
+        # the value to pass as ?after_id= for the next page. Without a limit, the template's whole history is
+        # streamed straight from the database. ?format=ndjson returns one JSON object per line instead of an array.
+        # Jobs that have been moved to the archive are included too, unless asked for ?archive=0.
+        after_id = count_arg(request.query.get('after_id'), 'after_id')
+        limit = count_arg(request.query.get('limit'), 'limit', minimum=1)
+        ndjson = request.query.get('format') == "ndjson"
+        include_archive = request.query.get('archive') not in ("0", "false")
+
+        if limit:
+            jobs = mb.get_jobs_for_template(template, params=params, after_id=after_id, limit=limit,
+                                            include_archive=include_archive)
+            if jobs is None:
+                abort(503, "The database is busy, try again later")
+            if len(jobs) == limit:
+                response.set_header('X-Next-After-Id', str(jobs[-1].get_id()))
+        else:
+            jobs = mb.iter_jobs_for_template(template, params=params, after_id=after_id, include_archive=include_archive)
+            # the first page is read before the response starts, so it can still be turned away; a later page that
+            # times out cuts the response short instead
+            try:
+                first = list(itertools.islice(jobs, 1))
+            except matriarch.DatabaseTimeout:
+                abort(503, "The database is busy, try again later")
+            jobs = itertools.chain(first, jobs)
 
         def get_job_data(job):
             toR = dict()
@@ -134,11 +248,58 @@ with matriarch.MatriarchBackend() as mb:
             toR['jobid'] = job.get_id();
             return toR
 
-        jobs = map(get_job_data, jobs)
-        return json.dumps(jobs)
+        jobs = (get_job_data(x) for x in jobs if x.is_complete() and not x.has_error())
+        response.content_type = 'application/x-ndjson' if ndjson else 'application/json'
+        return stream_json(jobs, ndjson=ndjson)
 
             
 
+    @route("/api/aggregates/<template>")
+    def api_aggregates(template):
+        # count, mean, variance, min and max of DURATION and each numeric result for every configuration of a
+        # template, e.g. /api/aggregates/sedov?regression_tag=reg_test&metric=DURATION
+        aggregates = mb.get_aggregates(template, tag=request.query.get('regression_tag'),
+                                       metric=request.query.get('metric'))
+        response.content_type = 'application/json'
+        return json.dumps(aggregates)
+
+    @route("/api/columns/<template>")
+    def api_columns(template):
+        # the template's completed jobs as an uncompressed .npz of typed columns, for numpy.load
+        if mb.get_template_index_by_name(template) is None:
+            abort(404, "No such template")
+
+        try:
+            cache = mb.get_column_cache(template)
+        except matriarch.DatabaseTimeout:
+            abort(503, "The database is busy, try again later")
+        if not cache:
+            abort(404, "The column cache is turned off")
+
+        f = tempfile.TemporaryFile()
+        cache.write_npz(template, f)
+        f.seek(0)
+        response.content_type = 'application/octet-stream'
+        response.set_header('Content-Disposition', 'attachment; filename="%s.npz"' % template)
+        return f
+
+    @route("/api/columns/<template>/<column>")
+    def api_column(template, column):
+        # a single column as a .npy file, which numpy.load(..., mmap_mode='r') can map without copying
+        if mb.get_template_index_by_name(template) is None:
+            abort(404, "No such template")
+
+        try:
+            cache = mb.get_column_cache(template)
+        except matriarch.DatabaseTimeout:
+            abort(503, "The database is busy, try again later")
+        path = dict(cache.columns(template)).get(column) if cache else None
+        if not path:
+            abort(404, "No such column")
+
+        return static_file(os.path.basename(path), root=os.path.dirname(path), mimetype='application/octet-stream',
+                           download=template + "_" + column + ".npy")
+
     @route('/static/<filepath:path>')
     def static(filepath):
         path = os.path.realpath(__file__)
@@ -147,5 +308,5 @@ with matriarch.MatriarchBackend() as mb:
         return static_file(filepath, root=path)
 
 
-    run(host='localhost', port=args.port)
+    run(host='localhost', port=args.port, server=args.server)
 
@@ -45,10 +45,23 @@ import xml.etree.ElementTree as ET
 import threading
 import json
 import sqlite3
+import collections
+import heapq
+import numbers
+import math
+import zlib
+import hashlib
 import time
 import functools
 import logging
 import config_reader
+import column_cache
+import db_metrics
+import db_maintenance
+import completion_pool
+import command_engine
+import schedulers
+import util
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -58,6 +71,55 @@ MACHINE_NAME = subprocess.check_output(["hostname"])[0:2]
 DEPLOYMENT_PATH = config.get_deployment(MACHINE_NAME)
 SPECIAL_VARS = ['machine', 'depends']
 
+# the CommandEngine that runs checkjob, deploy and extract commands, if the config has a `commands` section
+COMMANDS = None
+
+
+def start_command(args, kind, cwd=None, timeout=None):
+    """ starts `args` on the command engine, if there is one, and returns a function that waits for its output.
+    Without an engine the command runs when that function is called """
+    if COMMANDS:
+        return COMMANDS.submit(args, kind, machine=MACHINE_NAME, cwd=cwd, timeout=timeout).wait
+    return functools.partial(util.run_command, args, cwd=cwd, timeout=timeout)
+
+
+def run_command(args, kind, cwd=None, timeout=None):
+    return start_command(args, kind, cwd, timeout)()
+
+
+# the batch scheduler jobs are submitted to and checked on, picked by the config's `scheduler` section
+SCHEDULER = schedulers.open_scheduler(config.get_scheduler_options(), start_command)
+
+# how long (in seconds) JobMonitor waits before checking a job again, by its MOAB state. Running jobs are checked more
+# often as they near the end of their requested wall time, down to RUNNING_MIN_INTERVAL
+CHECK_INTERVALS = {'Idle': 300, 'Deferred': 600, 'BatchHold': 600, 'SystemHold': 600, 'UserHold': 600, 'Hold': 600,
+                   'Starting': 10, 'Running': 60}
+DEFAULT_CHECK_INTERVAL = 30
+RUNNING_MIN_INTERVAL = 5
+# how often JobMonitor rereads the run table, to pick up runs it wasn't told about
+RESYNC_INTERVAL = 300
+
+# the range of an SQLite INTEGER
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+# scheduler status fields that move on with every check of a job (elapsed and utilized seconds, queue priorities) and
+# the host that checked it. They are left out of a row's data_hash, so a check that changes nothing else doesn't
+# rewrite the row; nothing reads them back
+VOLATILE_FIELDS = ['AWDuration', 'EEDuration', 'SuspendDuration', 'StatPSDed', 'StatPSUtl', 'StatMSUtl',
+                   'StartPriority', 'hostname']
+
+# how the data column of the job and run tables is stored
+DATA_JSON = 0
+DATA_ZLIB = 1
+
+# classes of database reads, most urgent first: what the job and prerun monitors need to keep jobs moving, pages a
+# user is waiting on, and large scans for analysis or export
+PRIORITY_MONITOR = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BULK = 2
+PRIORITY_NAMES = ['monitor', 'interactive', 'bulk']
+
 
 logging.info("Matriarch started on " + MACHINE_NAME)
 logging.info("Using deployment directory " + DEPLOYMENT_PATH)
@@ -136,9 +198,9 @@ class Template:
 
         return toR
 
-    def __extract(self, name):
+    def __extract(self, name, timeout=None):
         script_dir = os.path.join(DEPLOYMENT_PATH, self.name, name)
-        result = subprocess.check_output(['python', 'extract'], cwd=script_dir)
+        result = run_command(['python', 'extract'], "extract", cwd=script_dir, timeout=timeout)
         return json.loads(result)
 
     def get_extract_func_for(self, name):
@@ -164,14 +226,10 @@ class Template:
             return None
         logging.debug("Deploying job %s by running script %s", name, script)
 
-        result = subprocess.check_output(script).rstrip().lstrip()
-        try:
-            result = int(result)
-            return MatriarchJob(name, params, result, self, extractFunc=functools.partial(self.__extract, name))
-        except ValueError:
-            print("Expected the deployment script to return a job ID, instead got:", result)
-
-        return None
+        result = SCHEDULER.submit(script, cwd=os.path.dirname(script[1]))
+        if result is None:
+            return None
+        return MatriarchJob(name, params, result, self, extractFunc=functools.partial(self.__extract, name))
 
 
         
@@ -209,8 +267,17 @@ class TemplateScanner:
 
         return None
 
+def completion_failed(code):
+    """ whether the scheduler's CompletionCode `code` means the job failed. checkjob reports it as a string, and
+    anything that isn't a number counts as a failure """
+    try:
+        return int(code) != 0
+    except (ValueError, TypeError):
+        return True
+
 class MOABJob:
-    """ provides functionality and information about a given MOAB job """
+    """ provides functionality and information about a given batch job. Whichever scheduler runs it, its information
+    is kept in MOAB's terms (see schedulers) """
 
     def __init__(self, job_id, info=None):
         self.job_id = job_id
@@ -222,25 +289,63 @@ class MOABJob:
 
     def refresh_info(self):
         try:
-            result = subprocess.check_output(["checkjob", "--xml", str(self.job_id)])
-        except subprocess.CalledProcessError:
-            with self.info_lock:
-                self.info['CompletionCode'] = -2
-                return
+            status = SCHEDULER.query(self.job_id)
+        except schedulers.SchedulerError:
+            status = None
+
+        if status is None:
+            self.__lost()
+            return
 
-        root = ET.fromstring(result)
+        return self.update_info(status, run_command(["hostname"], "hostname"))
 
+    def __lost(self):
+        # the scheduler couldn't tell us about the job
+        with self.info_lock:
+            self.info['CompletionCode'] = -2
+
+    def update_info(self, attrib, hostname):
+        """ replaces the job's information with its status from the scheduler. Returns True if that shows the job has
+        just completed """
         do_complete_hooks = False
         currently_complete = self.is_complete() or self.is_canceled()
 
         with self.info_lock:
-            self.info = root[0].attrib
-            self.info['hostname'] = subprocess.check_output(["hostname"])
+            self.info = attrib
+            self.info['hostname'] = hostname
             do_complete_hooks = (not currently_complete) and self.is_complete()
         
 
         return do_complete_hooks
 
+    @staticmethod
+    def refresh_many(jobs):
+        """ refreshes the information of every job in `jobs` with one batched status query, instead of one query per
+        job. Jobs missing from the answer count as lost: the scheduler has already asked about them one at a time.
+        Returns the jobs that have just completed """
+        hostname = run_command(["hostname"], "hostname")
+        try:
+            found = SCHEDULER.query_many([job.job_id for job in jobs])
+        except schedulers.SchedulerError as e:
+            logging.error("Checking %d jobs failed: %s", len(jobs), str(e))
+            return []
+
+        completed = []
+        for job in jobs:
+            try:
+                if str(job.job_id) not in found:
+                    job.__lost()
+                elif job.update_info(found[str(job.job_id)], hostname):
+                    completed.append(job)
+            except Exception as e:
+                # one job the scheduler's answer doesn't make sense for shouldn't hold up the rest
+                logging.error("Error checking job %s: %s", str(job.job_id), str(e))
+
+        return completed
+
+    def cancel(self):
+        SCHEDULER.cancel(self.job_id)
+
     def add_complete_callback(self, func):
         self.complete_callbacks.append(func)
 
@@ -282,7 +387,7 @@ class MOABJob:
             if self.is_canceled():
                 return False
 
-            return self.info['CompletionCode'] != 0
+            return completion_failed(self.info['CompletionCode'])
 
     def get_submission_time(self):
         with self.info_lock:
@@ -354,11 +459,12 @@ class MatriarchJob(MOABJob):
         self.orig_jobid = jobid
         self.resub_count = 0
 
-    def extract_output(self):
-        if self.extract_func:
-            up_with = self.extract_func()
+    def extract_output(self, timeout=None):
+        func = self.extract_func or self.template.get_extract_func_for(self.name)
+        if timeout is not None:
+            up_with = func(timeout=timeout)
         else:
-            up_with = self.template.get_extract_func_for(self.name)()
+            up_with = func()
 
         self.params.update(up_with)
 
@@ -395,7 +501,7 @@ class MatriarchJob(MOABJob):
 
             
 
-            return self.info['CompletionCode'] != 0
+            return completion_failed(self.info['CompletionCode'])
 
     def resubmit(self):
         if self.resub_count == 3:
@@ -420,7 +526,11 @@ class MatriarchJob(MOABJob):
 
     @staticmethod
     def from_json(d, templ_lookup):
-        obj = json.loads(d)
+        return MatriarchJob.from_data(json.loads(d), templ_lookup)
+
+    @staticmethod
+    def from_data(obj, templ_lookup):
+        """ like from_json, from the already decoded JSON. The job takes `obj` over and changes it """
         name = obj['matriarch']['name']
         params = obj['matriarch']['params']
         jobid = obj['moab']['jobid']
@@ -431,6 +541,47 @@ class MatriarchJob(MOABJob):
         return j
 
 
+class JobSummary(object):
+    """ the handful of fields list views need from a job, read straight from the job and run table columns instead of
+    rebuilding a MatriarchJob from its JSON. Offers the same accessors as MatriarchJob for those fields """
+    __slots__ = ('jobid', 'name', 'template_name', 'state', 'moab_state', 'hostname')
+
+    def __init__(self, jobid, name, template_name, state, moab_state, hostname):
+        self.jobid = jobid
+        self.name = name
+        self.template_name = template_name
+        self.state = state
+        self.moab_state = moab_state
+        self.hostname = hostname or ""
+
+    def get_id(self):
+        return self.jobid
+
+    def get_name(self):
+        return self.name
+
+    def get_template_name(self):
+        return self.template_name
+
+    def get_state(self):
+        return self.state
+
+    def get_hostname(self):
+        return self.hostname
+
+    def is_complete(self):
+        return self.moab_state == "Completed"
+
+    def is_running(self):
+        return self.moab_state == "Running"
+
+    def is_waiting(self):
+        return self.moab_state == "Idle" or self.moab_state == "Deferred"
+
+    def is_canceled(self):
+        return self.moab_state == "Removed"
+
+
 class MatriarchBackend:
     """ The main backend to Matriarch. Automatically imports templates from the CWD, and makes them available. Jobs submitted via the backend are automatically monitored. Also saves completed runs into the database."""
     def __init__(self):
@@ -439,16 +590,24 @@ class MatriarchBackend:
             self.ts.scan(td)
 
     def __enter__(self):
-        self.db = Database(self.ts.get_template_by_name, MACHINE_NAME)
-        self.jm = JobMonitor(self.db)
+        global COMMANDS
+        if config.get_command_options() is not None:
+            COMMANDS = command_engine.CommandEngine(**config.get_command_options())
+
+        self.db = Database(self.ts.get_template_by_name, MACHINE_NAME, **config.get_database_options())
+        self.jm = JobMonitor(self.db, **config.get_monitor_options())
         self.prm = PrerunMonitor(self.db, self.ts.get_template_by_name)
 
         return self
 
     def __exit__(self, ty, value, traceback):
+        global COMMANDS
         self.jm.close()
         self.db.close()
         self.prm.close()
+        if COMMANDS:
+            COMMANDS.close()
+            COMMANDS = None
 
     def get_templates(self):
         return self.ts.get_templates()
@@ -467,17 +626,59 @@ class MatriarchBackend:
     def submit_job(self, tmpl_name, name, params, machine=MACHINE_NAME, depends_on=[]):
         self.db.insert_prerun({'name': name, 'template': tmpl_name, 'data': params, 'machine': machine, 'depends': depends_on})
 
+    def submit_jobs(self, requests):
+        """ submits every job in `requests`, each a dict like the ones /api/submit takes, in a single transaction.
+        Returns their prerun ids in the same order """
+        preruns = [{'name': r['NAME'], 'template': r['template'], 'data': r, 'machine': r.get('machine', MACHINE_NAME),
+                    'depends': r.get('depends', [])} for r in requests]
+        return self.db.insert_preruns_many(preruns)
+
     def get_jobs(self):
         toR = []
         toR.extend(self.db.get_runs())
         toR.extend(self.db.get_jobs())
         return toR
 
+    def get_job_summaries(self, limit=100, after_id=None):
+        # the first page also lists everything that is still running
+        # None if either query timed out
+        toR = []
+        if after_id is None:
+            runs = self.db.get_run_summaries()
+            if runs == None:
+                return None
+            toR.extend(runs)
+        jobs = self.db.get_job_summaries(limit=limit, after_id=after_id)
+        if jobs == None:
+            return None
+        toR.extend(jobs)
+        return toR
+
     def delete_job_by_id(self, jobid):
         self.db.delete_job(jobid)
 
-    def get_jobs_for_template(self, template):
-        return self.db.get_jobs_for_template(template);
+    def get_jobs_for_template(self, template, params=None, after_id=None, limit=None, include_archive=False):
+        return self.db.get_jobs_for_template(template, params=params, after_id=after_id, limit=limit,
+                                             include_archive=include_archive);
+
+    def iter_jobs_for_template(self, template, params=None, after_id=None, include_archive=False):
+        return self.db.iter_jobs_for_template(template, params=params, after_id=after_id,
+                                              include_archive=include_archive)
+
+    def get_column_cache(self, template):
+        return self.db.get_column_cache(template)
+
+    def get_db_metrics(self):
+        return self.db.get_metrics()
+
+    def get_completion_stats(self):
+        return self.jm.get_completion_stats()
+
+    def get_command_stats(self):
+        return COMMANDS.get_stats() if COMMANDS else None
+
+    def get_aggregates(self, template, tag=None, metric=None):
+        return self.db.get_aggregates(template, tag=tag, metric=metric)
         
     def get_machines(self):
         return config.get_machines()
@@ -508,8 +709,8 @@ class PrerunMonitor:
                 traceback.print_exc()
 
     def __evaluate_depends(self, depends):
-        jobs = self.db.get_jobs(limit=1000)
-        jobs.extend(self.db.get_runs())
+        jobs = self.db.get_job_summaries(limit=1000, priority=PRIORITY_MONITOR)
+        jobs.extend(self.db.get_run_summaries(priority=PRIORITY_MONITOR))
         def name_to_id(job_name):
             if job_name[0] == "#":
                 # it's already a job id
@@ -550,7 +751,7 @@ class PrerunMonitor:
                 break
 
             # check to see if this dependency is complete
-            job = self.db.get_job_by_id(depend[1:]) # cut off the leading #
+            job = self.db.get_job_by_id(depend[1:], priority=PRIORITY_MONITOR) # cut off the leading #
             if not job.is_complete():
                 logging.debug("Prerun %d is waiting on job %s", toSub['id'], depend)
                 all_depends = False
@@ -591,14 +792,48 @@ class PrerunMonitor:
         self.exitEvent.set()
 
 
+def check_interval(state, info=None, now=None):
+    """ how long to wait before checking a job in MOAB state `state` again. With the job's checkjob attributes in
+    `info`, a running job is checked every quarter of its remaining wall time, within RUNNING_MIN_INTERVAL and the
+    usual interval for running jobs """
+    interval = CHECK_INTERVALS.get(state, DEFAULT_CHECK_INTERVAL)
+    if state != "Running" or not info:
+        return interval
+
+    try:
+        remaining = int(info['StartTime']) + int(info['ReqAWDuration']) - (now or time.time())
+    except (KeyError, ValueError, TypeError):
+        return interval
+    return max(RUNNING_MIN_INTERVAL, min(interval, remaining / 4.0))
+
+
 class JobMonitor:
-    def __init__(self, db):
+    """ checks on this machine's runs. Each run has a deadline for its next check in a heap, set by check_interval
+    from its state, and the thread sleeps until the earliest one (or until a new run is inserted), then checks every
+    run that is due at once.
+
+    Finished jobs are handed to a pool of `completion_workers` threads to run their extract script, set globals and
+    call callbacks, so one slow extract script doesn't hold up checking the others. An extract script is killed after
+    `completion_timeout` seconds, and at most `completion_queue_size` finished jobs wait for a worker """
+    def __init__(self, db, completion_workers=4, completion_timeout=3600, completion_queue_size=1000):
         self.db = db
         self.exitEvent = threading.Event()
+        self.completions = completion_pool.CompletionPool(completion_workers, completion_timeout, completion_queue_size)
 
         self.callbacks = {}
         self.cbLock = threading.RLock()
 
+        # (deadline, job id) pairs, plus the current deadline of each job. A job that is rescheduled leaves its old
+        # pair behind, which is skipped when it comes up
+        self.wake = threading.Condition()
+        self.deadlines = []
+        self.nextCheck = {}
+        self.nextResync = 0
+        # runs that were already Completed in the table when the monitor started, and so may never have been
+        # finished. Filled in by the first resync, and each of them is finished the first time it is checked
+        self.recovering = None
+
+        self.db.add_run_listener(self.__run_inserted)
 
         self.t = threading.Thread(target=self.__run_thread)
         logging.debug("Starting job monitoring thread")
@@ -623,286 +858,1635 @@ class JobMonitor:
                 import traceback
                 traceback.print_exc()
 
+    def __schedule(self, jobid, when):
+        # called with wake held
+        self.nextCheck[jobid] = when
+        heapq.heappush(self.deadlines, (when, jobid))
+
+    def __run_inserted(self, job):
+        # runs the monitor already tracks are rescheduled after each check; only new ones need checking right away
+        if job.is_complete() or job.is_canceled():
+            return
+        with self.wake:
+            if job.get_id() not in self.nextCheck:
+                self.__schedule(job.get_id(), time.time())
+                self.wake.notify()
+
+    def __resync(self):
+        rows = self.db.get_run_schedule()
+        if rows == None:
+            return
+        with self.wake:
+            if self.recovering == None:
+                self.recovering = set(jobid for jobid, state, last_checked in rows if state == "Completed")
+            for jobid, state, last_checked in rows:
+                if jobid not in self.nextCheck and not self.completions.is_pending(jobid):
+                    self.__schedule(jobid, (last_checked or 0) + check_interval(state))
+
+    def __recovered(self, jobid):
+        with self.wake:
+            if self.recovering and jobid in self.recovering:
+                self.recovering.remove(jobid)
+                return True
+            return False
+
+    def __take_due(self):
+        """ sleeps until a run is due a check (or it is time to resync), and returns the ids of every run due by then.
+        Returns None once the monitor is closed """
+        with self.wake:
+            while not self.exitEvent.is_set():
+                wait = self.nextResync - time.time()
+                if self.deadlines:
+                    wait = min(wait, self.deadlines[0][0] - time.time())
+                if wait <= 0:
+                    break
+                self.wake.wait(wait)
+
+            if self.exitEvent.is_set():
+                return None
+
+            now = time.time()
+            due = []
+            while self.deadlines and self.deadlines[0][0] <= now:
+                when, jobid = heapq.heappop(self.deadlines)
+                if self.nextCheck.get(jobid) == when:
+                    due.append(jobid)
+                    # a check that fails part way still gets retried
+                    self.__schedule(jobid, now + DEFAULT_CHECK_INTERVAL)
+            return due
+
     def __monitor_loop(self):
         logging.debug("Job monitoring thread started")
-        local = threading.local()
-
-        last = 0
-        last_time = 0
 
         while True:
-            if self.exitEvent.is_set():
+            ids = self.__take_due()
+            if ids == None:
                 break;
 
-            job = self.db.get_last_incomplete_job()
-            if job == None:
+            if time.time() >= self.nextResync:
+                self.nextResync = time.time() + RESYNC_INTERVAL
+                self.__resync()
+
+            if not ids:
                 continue
 
-            if job.get_id() == last and (time.time() - last_time) <= 10:
+            jobs = self.db.get_runs_by_ids(ids)
+            if jobs == None:
                 continue
 
-            last = job.get_id()
-            last_time = time.time()
+            # runs that have gone from the table were finished elsewhere (or deleted)
+            found = set(job.get_id() for job in jobs)
+            with self.wake:
+                for jobid in ids:
+                    if jobid not in found:
+                        self.nextCheck.pop(jobid, None)
+
+            if not jobs:
+                continue
 
-            logging.debug("Checking job %d in the monitor thread", job.get_id())
+            logging.debug("Checking %d jobs in the monitor thread", len(jobs))
 
-            just_completed = job.refresh_info()
+            completed = set(job.get_id() for job in MOABJob.refresh_many(jobs))
 
-            # refresh the job in the DB
-            self.db.insert_run(job)
+            now = time.time()
+            with self.wake:
+                for job in jobs:
+                    if job.is_complete() or job.is_canceled():
+                        self.nextCheck.pop(job.get_id(), None)
+                    else:
+                        self.__schedule(job.get_id(), now + check_interval(MOABJob.get_state(job), job.info, now))
 
-            if just_completed:
-                logging.debug("Doing data extraction for job %d...", job.get_id())
-                job.extract_output()
+            # refresh the jobs in the DB, all in the same transaction
+            self.db.insert_runs(jobs)
 
-                if 'MATRIARCH_SET_GLOBALS' in job.get_params():
-                    logging.debug("Processing globals set by job %d...", job.get_id())
-                    for k, v in job.get_params()['MATRIARCH_SET_GLOBALS'].items():
-                        logging.debug("Setting global variable %s to %s", k, v)
-                        self.db.insert_global(k, v)
+            for job in jobs:
+                # only a job that has just completed is finished. One that stays Completed in the run table after
+                # that (a failed job being resubmitted) goes straight to __process_checked, unless it completed
+                # before a restart
+                if job.get_id() in completed or self.__recovered(job.get_id()):
+                    self.completions.submit(job.get_id(), functools.partial(self.__complete, job))
+                    continue
 
-                logging.debug("Processing callbacks for job %d...", job.get_id())
-                jid = job.get_id()
-                with self.cbLock:
-                    cbs = []
-                    if jid in self.callbacks:
-                        cbs = self.callbacks[jid]
-                        del self.callbacks[jid]
+                try:
+                    self.__process_checked(job)
+                except Exception as e:
+                    logging.error("Error processing job %d in the monitor thread: %s", job.get_id(), str(e))
 
-                for c in cbs:
-                    c(job)
+    def __complete(self, job, timeout):
+        # runs on a completion worker
+        logging.debug("Doing data extraction for job %d...", job.get_id())
+        try:
+            job.extract_output(timeout=timeout)
+        except Exception as e:
+            # the job is still recorded, just without what its extract script would have added
+            logging.error("Data extraction for job %d failed: %s", job.get_id(), str(e))
+
+        if 'MATRIARCH_SET_GLOBALS' in job.get_params():
+            logging.debug("Processing globals set by job %d...", job.get_id())
+            for k, v in job.get_params()['MATRIARCH_SET_GLOBALS'].items():
+                logging.debug("Setting global variable %s to %s", k, v)
+                self.db.insert_global(k, v)
+
+        logging.debug("Processing callbacks for job %d...", job.get_id())
+        jid = job.get_id()
+        with self.cbLock:
+            cbs = []
+            if jid in self.callbacks:
+                cbs = self.callbacks[jid]
+                del self.callbacks[jid]
 
+        for c in cbs:
+            c(job)
 
-            if job.has_error():
-                logging.info("Job %d failed. Resubmitting...", job.get_id())
-                if job.resubmit():
-                    self.db.insert_run(job)
-                    continue
-                else:
-                    # won't resubmit
-                    self.db.insert_job(job)
-                    self.db.remove_run(job)
-                    continue
+        self.__process_checked(job)
 
-            if job.is_complete() or job.is_canceled():
-                logging.info("Job %d complete, removing it from runs and adding it to jobs", job.get_id())
+    def __process_checked(self, job):
+        if job.has_error():
+            logging.info("Job %d failed. Resubmitting...", job.get_id())
+            if job.resubmit():
+                self.db.insert_run(job)
+            else:
+                # won't resubmit
                 self.db.insert_job(job)
                 self.db.remove_run(job)
+            return
+
+        if job.is_complete() or job.is_canceled():
+            logging.info("Job %d complete, removing it from runs and adding it to jobs", job.get_id())
+            self.db.insert_job(job)
+            self.db.remove_run(job)
+
 
+    def get_completion_stats(self):
+        return self.completions.get_stats()
 
     def close(self):
         self.exitEvent.set()
+        with self.wake:
+            self.wake.notify()
+        self.completions.close()
             
+class DatabaseTimeout(Exception):
+    pass
+
+
+class DatabaseRequest:
+    """ a handle on one piece of work queued for the DB thread. It completes as soon as the DB thread has run the query
+    (or committed the write), and can be waited on with a timeout or cancelled while it is still queued """
+    def __init__(self, sql=None, values=None, priority=PRIORITY_INTERACTIVE):
+        self.sql = sql
+        self.values = values
+        self.priority = priority
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.created = time.time()
+
+    def set_result(self, result):
+        with self.lock:
+            if self.done.is_set():
+                return False
+            self.result = result
+            self.done.set()
+            return True
+
+    def set_error(self, error):
+        with self.lock:
+            if self.done.is_set():
+                return False
+            self.error = error
+            self.done.set()
+            return True
+
+    def cancel(self):
+        """ cancels the request if the DB thread has not run it yet. Returns True if the request was cancelled """
+        with self.lock:
+            if self.done.is_set():
+                return self.cancelled
+            self.cancelled = True
+            self.done.set()
+            return True
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def is_done(self):
+        return self.done.is_set()
+
+    def wait(self, timeout=None):
+        """ waits for the result, raising DatabaseTimeout if it does not arrive within `timeout` seconds. Errors raised
+        by SQLite are re-raised here """
+        if not self.done.wait(timeout):
+            raise DatabaseTimeout("Database request did not complete within " + str(timeout) + " seconds")
+
+        if self.error:
+            raise self.error
+
+        return self.result
+
+
+def copy_data(value):
+    """ a copy of decoded JSON that shares nothing mutable with `value`. Strings and numbers are immutable, so they are
+    shared rather than copied """
+    if isinstance(value, dict):
+        copy = dict(value)
+        for k, v in value.items():
+            if isinstance(v, (dict, list)):
+                copy[k] = copy_data(v)
+        return copy
+    if isinstance(value, list):
+        return [copy_data(v) if isinstance(v, (dict, list)) else v for v in value]
+    return value
+
+
+class JobCache:
+    """ a bounded LRU cache of the parsed JSON of rows in the job and run tables, keyed by job id and the version of
+    the row it was read from, so a rewritten row is never served stale. Every read builds its own MatriarchJob from a
+    copy of the cached data, since the monitor changes the jobs it is handed """
+    def __init__(self, size):
+        self.size = size
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, jobid, version):
+        with self.lock:
+            entry = self.jobs.pop(jobid, None)
+            if entry == None or entry[0] != version:
+                self.misses += 1
+                return None
+
+            # most recently used goes to the end
+            self.jobs[jobid] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, jobid, version, data):
+        with self.lock:
+            self.jobs.pop(jobid, None)
+            self.jobs[jobid] = (version, data)
+            while len(self.jobs) > self.size:
+                self.jobs.popitem(last=False)
+
+    def invalidate(self, jobid):
+        with self.lock:
+            self.jobs.pop(jobid, None)
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.jobs)}
+
+
+class SQLiteStorage:
+    """ keeps the job database in a SQLite file. Database opens its connections through a storage object, so where
+    the data lives can change without touching the queries """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def is_persistent(self):
+        return True
+
+    def connect(self):
+        # the connection the DB thread reads and writes through
+        return sqlite3.connect(self.path, isolation_level=None)
+
+    def connect_reader(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA query_only = ON;")
+        return conn
+
+
+class MemoryStorage:
+    """ keeps the job database in memory, for benchmarks and throwaway instances: nothing touches the disk, every
+    Database gets its own empty database, and everything is gone once it is closed. Only the DB thread's connection
+    can see an in-memory database, so there are no reader connections """
+    path = ":memory:"
+
+    def is_persistent(self):
+        return False
+
+    def connect(self):
+        return sqlite3.connect(":memory:", isolation_level=None)
+
+    def connect_reader(self):
+        raise sqlite3.NotSupportedError("An in-memory database can only be read through the DB thread")
+
+
+def open_storage(path):
+    """ the storage for a database option `path`: a file name, or ":memory:" """
+    if path == ":memory:":
+        return MemoryStorage()
+    return SQLiteStorage(path)
+
+
+class ReaderPool:
+    """ a bounded pool of read-only connections to a WAL-mode database. Connections are opened lazily, up to `size` of
+    them, and a reader that finds them all busy waits for one to be returned. Waiting readers are let through most
+    urgent class first (oldest first within a class), except that one that has waited `starvation_limit` seconds goes
+    ahead of more urgent ones, as on the DB thread. Bulk reads never hold the last connection. How long readers of each
+    class waited goes to `metrics`. If `archive_path` is given, the archive database is attached to every connection as
+    `archive` """
+    def __init__(self, storage, size, archive_path=None, pragmas=(), starvation_limit=1.0, metrics=None):
+        self.storage = storage
+        self.size = size
+        self.archive_path = archive_path
+        self.pragmas = pragmas
+        self.starvation_limit = starvation_limit
+        self.metrics = metrics
+        self.idle = collections.deque()
+        self.created = 0
+        self.closed = False
+        self.lock = threading.Condition()
+        # the arrival time of each waiting reader, by class. A reader is its own entry, a one element list, so two
+        # readers that arrive at the same time can be told apart
+        self.waiting = [collections.deque() for name in PRIORITY_NAMES]
+        self.bulk = 0
+
+    def __connect(self):
+        conn = self.storage.connect_reader()
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        if self.archive_path:
+            conn.execute("ATTACH DATABASE ? AS archive", [self.archive_path])
+        return conn
+
+    def __blocked(self, priority):
+        # called with lock held
+        return priority == PRIORITY_BULK and self.size > 1 and self.bulk >= self.size - 1
+
+    def __may_take(self, priority, entry, now):
+        # called with lock held
+        if self.__blocked(priority) or (len(self.idle) == 0 and self.created >= self.size):
+            return False
+
+        starving = [queue[0] for p, queue in enumerate(self.waiting)
+                    if len(queue) != 0 and now - queue[0][0] >= self.starvation_limit and not self.__blocked(p)]
+        if starving:
+            return entry is min(starving, key=lambda e: e[0])
+
+        if any(len(self.waiting[p]) != 0 for p in range(priority)):
+            return False
+        return self.waiting[priority][0] is entry
+
+    def __acquire(self, priority):
+        with self.lock:
+            entry = [time.time()]
+            self.waiting[priority].append(entry)
+            if self.metrics:
+                self.metrics.record_depth(PRIORITY_NAMES[priority], len(self.waiting[priority]))
+            try:
+                while not self.closed:
+                    now = time.time()
+                    if self.__may_take(priority, entry, now):
+                        break
+                    # woken when a connection is returned, or when this reader has waited long enough to starve
+                    remaining = entry[0] + self.starvation_limit - now
+                    self.lock.wait(remaining if remaining > 0 else None)
+            finally:
+                self.waiting[priority].remove(entry)
+
+            if self.closed:
+                raise sqlite3.ProgrammingError("Cannot read from a closed database")
+
+            if self.metrics:
+                self.metrics.record_wait(PRIORITY_NAMES[priority], time.time() - entry[0])
+
+            if priority == PRIORITY_BULK:
+                self.bulk += 1
+
+            # whoever is next in line may be able to take a connection too
+            self.lock.notify_all()
+
+            if len(self.idle) != 0:
+                return self.idle.pop()
+
+            self.created += 1
+
+        try:
+            return self.__connect()
+        except:
+            with self.lock:
+                self.created -= 1
+                if priority == PRIORITY_BULK:
+                    self.bulk -= 1
+                self.lock.notify_all()
+            raise
+
+    def __release(self, conn, priority):
+        with self.lock:
+            if priority == PRIORITY_BULK:
+                self.bulk -= 1
+            if self.closed:
+                conn.close()
+                return
+            self.idle.append(conn)
+            # readers wait on different conditions, so wake them all to let the most urgent one in
+            self.lock.notify_all()
+
+    def run(self, sql, values, priority=PRIORITY_INTERACTIVE):
+        conn = self.__acquire(priority)
+        try:
+            c = conn.cursor()
+            c.execute(sql, values)
+            return c.fetchall()
+        finally:
+            self.__release(conn, priority)
+
+    def get_depths(self):
+        """ how many readers of each class are waiting for a connection """
+        with self.lock:
+            return dict(zip(PRIORITY_NAMES, [len(queue) for queue in self.waiting]))
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            while len(self.idle) != 0:
+                self.idle.pop().close()
+            self.lock.notify_all()
+
+
 class Database:
-    """ a class to take care of some database functionality. Implemented on it's own thread with very course locking """
-    def __init__(self, templ_lookup, machine_name):
+    """ a class to take care of some database functionality. Implemented on it's own thread with very course locking.
+
+    Writes are queued and committed by the DB thread in groups: everything pending is drained in transactions of at most
+    `batch_size` rows. A partial batch is held back for at most `flush_deadline` seconds (or until a query arrives) so
+    that bursts of inserts share a single commit.
+
+    With `read_pool_size` set, the database is switched to WAL mode and reads are served by a pool of read-only
+    connections in the calling thread, so only writes (and deletes) go through the DB thread. Reads still wait for any
+    writes queued before them to be committed.
+
+    Queries are served one at a time, most urgent class first (see PRIORITY_NAMES), after committing every write
+    queued so far. A query that has waited `starvation_limit` seconds is served ahead of more urgent ones, so a steady
+    stream of monitor reads can't hold up a page forever.
+
+    The database lives in the file `path` (relative paths for the archive and column cache below are taken relative to
+    its directory). A `path` of ":memory:" keeps everything in memory instead, with no reader pool, archive or
+    column cache, which is meant for benchmarks and isolated test instances.
+
+    With `archive_after` set, jobs that completed more than that many seconds ago are moved out of the job table into
+    a separate archive database (`archive_path`), with their data stored compressed. The DB thread moves them a batch
+    at a time, checking every `archive_interval` seconds. Lookups by id always find archived jobs; template queries
+    only include them when asked to.
+
+    Job data longer than `compress_threshold` bytes is stored zlib compressed. Rows record how their data is stored,
+    so changing the threshold (or setting it to None to turn compression off) never affects rows already written.
+
+    Every `maintenance_interval` seconds (None turns it off), once the DB thread has been idle for `maintenance_idle`
+    seconds, it spends up to `maintenance_budget` seconds on housekeeping (see db_maintenance): freeing pages left by
+    deleted rows, checkpointing the WAL, and refreshing the query planner's statistics. `cache_size_kb`, `mmap_size`
+    (bytes) and `synchronous` set the matching SQLite pragmas on every connection; left as None, SQLite's defaults
+    apply. """
+    def __init__(self, templ_lookup, machine_name, path="matriarch.db", batch_size=500, flush_deadline=0.05, query_timeout=None,
+                 read_pool_size=0, column_cache_dir="matriarch_columns", job_cache_size=1000,
+                 archive_after=None, archive_path="matriarch_archive.db", archive_interval=3600,
+                 compress_threshold=4096, starvation_limit=1.0, maintenance_interval=3600, maintenance_idle=5.0,
+                 maintenance_budget=0.5, cache_size_kb=None, mmap_size=None, synchronous=None):
         self.newData = threading.Condition()
-        self.toInsert = []
-        self.toQuery = []
-        self.toInsertRuns = []
-        self.toInsertPreruns = []
-        self.toInsertGlobals = []
+        self.toWrite = collections.deque()
+        # the queued write for each job (or global) that has one, so a newer write can take its place
+        self.pendingWrites = {}
+        # one queue of read requests per priority class
+        self.toQuery = [collections.deque() for name in PRIORITY_NAMES]
+        self.starvation_limit = starvation_limit
+        self.firstPending = None
+        self.flushRequested = False
+
+        self.batch_size = max(1, int(batch_size))
+        self.flush_deadline = flush_deadline
+        self.rowsWritten = 0
+        self.commits = 0
+        self.metrics = db_metrics.DatabaseMetrics()
+        self.statusUpdates = 0
+        self.coalesced = 0
+        self.skipped = 0
+
+        self.query_timeout = query_timeout
+        self.closed = False
+
+        # every queued write gets a sequence number so readers can wait for the ones queued before them
+        self.queuedSeq = 0
+        self.committedSeq = 0
+        self.committed = threading.Condition()
+
+        self.storage = open_storage(path)
+        self.path = self.storage.path
+        self.ready = threading.Event()
+
+        persistent = self.storage.is_persistent()
+        if not persistent:
+            if read_pool_size > 0 or archive_after is not None:
+                logging.warning("The reader pool and the archive are not available for an in-memory database")
+            read_pool_size, archive_path, column_cache_dir = 0, None, None
+        else:
+            base = os.path.dirname(self.path)
+            archive_path = archive_path and os.path.join(base, archive_path)
+            column_cache_dir = column_cache_dir and os.path.join(base, column_cache_dir)
+
+        # an archive left behind by an earlier configuration is still read from, it just doesn't grow
+        self.archive_after = archive_after
+        self.archive_interval = archive_interval
+        self.archivePath = None
+        if archive_path and (archive_after is not None or os.path.exists(archive_path)):
+            self.archivePath = archive_path
+        self.nextArchive = time.time()
+        self.rowsArchived = 0
+
+        self.compress_threshold = compress_threshold
+
+        self.pragmas = []
+        if cache_size_kb is not None:
+            # a negative cache_size is in KiB rather than pages
+            self.pragmas.append("PRAGMA cache_size = %d" % -int(cache_size_kb))
+        if mmap_size is not None:
+            self.pragmas.append("PRAGMA mmap_size = %d" % int(mmap_size))
+        if synchronous is not None:
+            if str(synchronous).upper() not in ["OFF", "NORMAL", "FULL", "EXTRA"]:
+                raise ValueError("synchronous must be one of OFF, NORMAL, FULL or EXTRA, not " + repr(synchronous))
+            self.pragmas.append("PRAGMA synchronous = " + str(synchronous).upper())
+
+        self.maintenance = None
+        if persistent and maintenance_interval is not None:
+            self.maintenance = db_maintenance.Maintenance(["main"] + (["archive"] if self.archivePath else []),
+                                                          interval=maintenance_interval, idle=maintenance_idle,
+                                                          budget=maintenance_budget)
+        self.lastActivity = time.time()
+
+        self.readers = None
+        if read_pool_size > 0:
+            self.readers = ReaderPool(self.storage, read_pool_size, archive_path=self.archivePath, pragmas=self.pragmas,
+                                      starvation_limit=starvation_limit, metrics=self.metrics)
+
+        self.jobCache = None
+        if job_cache_size > 0:
+            self.jobCache = JobCache(job_cache_size)
+        self.rowVersion = 0
+        self.runListeners = []
+
+        self.columns = None
+        if column_cache_dir:
+            self.columns = column_cache.ColumnCache(column_cache_dir)
 
-        self.cqLock = threading.Condition()
-        self.completeQueries = {}
+        self.tlf = templ_lookup
+        self.machine = machine_name
 
         self.exitEvent = threading.Event()
         self.t = threading.Thread(name="db thread", target=self.__db_loop)
         self.t.start()
 
-        self.qcLock = threading.Lock()
-        self.q_count = 0
-
-        self.tlf = templ_lookup
-        self.machine = machine_name
-
     def close(self):
         self.exitEvent.set()
+        with self.newData:
+            self.newData.notify()
+        if self.readers:
+            self.readers.close()
 
     def __db_loop(self):
-        with sqlite3.connect('matriarch.db', isolation_level = None) as db:
+        with self.storage.connect() as db:
+            try:
+                for pragma in self.pragmas:
+                    db.cursor().execute(pragma)
+                if self.maintenance:
+                    self.__use_incremental_vacuum(db, "main")
+                if self.readers:
+                    db.cursor().execute("PRAGMA journal_mode = WAL;")
+
+                # attached first, so migrations that look at every job can see the archived ones too
+                if self.archivePath:
+                    self.__attach_archive(db)
+                self.__migrate(db)
+                self.rowVersion = db.cursor().execute("SELECT max(ifnull((SELECT max(version) FROM job), 0), ifnull((SELECT max(version) FROM run), 0))").fetchone()[0]
+                self.ready.set()
+
+                while True:
+                    with self.newData:
+                        while not self.__work_due():
+                            self.newData.wait(self.__time_to_deadline())
+
+                        if self.exitEvent.is_set() and len(self.toWrite) == 0 and self.__queries_pending() == 0:
+                            return
+
+                        # take a snapshot of the pending writes and the next query to serve. Anything queued after
+                        # this point waits for the next pass, so a query always sees the writes queued before it.
+                        self.metrics.record_depth('write', len(self.toWrite))
+                        for name, queue in zip(PRIORITY_NAMES, self.toQuery):
+                            self.metrics.record_depth(name, len(queue))
+                        writes = list(self.toWrite)
+                        self.toWrite.clear()
+                        self.pendingWrites.clear()
+                        self.firstPending = None
+                        self.flushRequested = False
+                        snapshotSeq = self.queuedSeq
+                        query = self.__next_query()
+
+                    now = time.time()
+                    for kind, item, req in writes:
+                        self.metrics.record_wait('write', now - req.created)
+                    if query:
+                        self.metrics.record_wait(PRIORITY_NAMES[query.priority], now - query.created)
+
+                    for i in range(0, len(writes), self.batch_size):
+                        self.__write_batch(db, writes[i:i + self.batch_size])
+
+                    with self.committed:
+                        self.committedSeq = snapshotSeq
+                        self.committed.notify_all()
+
+                    if query:
+                        self.__run_query(db, query)
+                        self.metrics.record_latency(PRIORITY_NAMES[query.priority], time.time() - query.created)
+
+                    if writes or query:
+                        self.lastActivity = time.time()
+
+                    if self.__archive_due():
+                        self.__archive_jobs(db)
+
+                    if self.__maintenance_due():
+                        self.__run_maintenance(db)
+            finally:
+                self.__shut_down()
+
+    def __migrate(self, db):
+        """ brings the database up to the current schema version. Each migration commits together with the bump of
+        schema_version, so an interrupted upgrade picks up where it left off the next time Matriarch starts """
+        migrations = [self.__schema_base_tables,
+                      self.__schema_param_table,
+                      self.__schema_job_primary_key,
+                      self.__schema_monitor_indexes,
+                      self.__schema_summary_columns,
+                      self.__schema_row_versions,
+                      self.__schema_completion_time,
+                      self.__schema_data_format,
+                      self.__schema_run_data_hash,
+                      self.__schema_job_data_hash,
+                      self.__schema_aggregate_table,
+                      self.__schema_job_aggregated]
+
+        c = db.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER)")
+        row = c.execute("SELECT version FROM schema_version").fetchone()
+        version = row[0] if row else 0
+
+        for v in range(version + 1, len(migrations) + 1):
+            logging.info("Upgrading %s to schema version %d", self.path, v)
+            c.execute("BEGIN")
             try:
-                db.cursor().execute("SELECT * FROM job;")
+                migrations[v - 1](c)
+                c.execute("DELETE FROM schema_version")
+                c.execute("INSERT INTO schema_version (version) VALUES (?)", [v])
+                c.execute("COMMIT")
             except:
-                db.cursor().execute("CREATE TABLE job (id INTEGER PRIMIARY KEY, template TEXT, data TEXT);")
+                logging.error("Schema migration to version %d failed", v)
+                self.__rollback(c)
+                raise
+
+    def __table_exists(self, c, name):
+        return c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", [name]).fetchone() != None
+
+    def __schema_base_tables(self, c):
+        # the original schema. Databases created before schema_version existed already have these tables.
+        c.execute("CREATE TABLE IF NOT EXISTS job (id INTEGER, template TEXT, data TEXT)")
+        c.execute("CREATE TABLE IF NOT EXISTS run (id INTEGER PRIMARY KEY, machine TEXT, state INTEGER, data TEXT, last_checked INTEGER)")
+        c.execute("CREATE TABLE IF NOT EXISTS prerun (id INTEGER PRIMARY KEY AUTOINCREMENT, machine TEXT, name TEXT, template TEXT, data TEXT, depends TEXT, last_checked INTEGER)")
+        c.execute("CREATE TABLE IF NOT EXISTS globals (key TEXT PRIMARY KEY, value TEXT)")
+
+    def __schema_param_table(self, c):
+        # one row per scalar job parameter (or extracted result), so jobs can be selected by parameter in SQL
+        if self.__table_exists(c, "param"):
+            return
 
+        c.execute("CREATE TABLE param (job_id INTEGER, key TEXT, value, PRIMARY KEY (job_id, key))")
+        c.execute("CREATE INDEX param_key_value ON param (key, value)")
+
+        # fill it in from the jobs and runs that are already stored
+        for table in ["job", "run"]:
+            for row in c.connection.cursor().execute("SELECT id, data FROM " + table):
+                params = json.loads(row[1])['matriarch']['params']
+                self.__sync_params(c, row[0], params)
+
+    def __schema_job_primary_key(self, c):
+        # the job table used to be declared with "id INTEGER PRIMIARY KEY", so id was never actually a key. Rebuild
+        # it with a real one, keeping the newest copy of any job that was inserted twice.
+        c.execute("CREATE TABLE job_pk (id INTEGER PRIMARY KEY, template TEXT, data TEXT)")
+        c.execute("INSERT OR REPLACE INTO job_pk (id, template, data) SELECT id, template, data FROM job ORDER BY rowid")
+        c.execute("DROP TABLE job")
+        c.execute("ALTER TABLE job_pk RENAME TO job")
+
+    def __schema_monitor_indexes(self, c):
+        # columns the job and prerun monitors filter on every tick, and the template filter behind /api/data
+        c.execute("CREATE INDEX IF NOT EXISTS run_machine_state_checked ON run (machine, state, last_checked)")
+        c.execute("CREATE INDEX IF NOT EXISTS prerun_machine_checked ON prerun (machine, last_checked)")
+        c.execute("CREATE INDEX IF NOT EXISTS prerun_name ON prerun (name)")
+        c.execute("CREATE INDEX IF NOT EXISTS job_template ON job (template)")
+
+    def __schema_summary_columns(self, c):
+        # copies of the fields list views show, so they can be read without parsing the data blob
+        c.execute("ALTER TABLE job ADD COLUMN name TEXT")
+        c.execute("ALTER TABLE job ADD COLUMN state TEXT")
+        c.execute("ALTER TABLE job ADD COLUMN moab_state TEXT")
+        c.execute("ALTER TABLE job ADD COLUMN hostname TEXT")
+        c.execute("ALTER TABLE run ADD COLUMN name TEXT")
+        c.execute("ALTER TABLE run ADD COLUMN template TEXT")
+        c.execute("ALTER TABLE run ADD COLUMN moab_state TEXT")
+        c.execute("ALTER TABLE run ADD COLUMN hostname TEXT")
+
+        for table in ["job", "run"]:
+            for row in c.connection.cursor().execute("SELECT id, data FROM " + table):
+                job = MatriarchJob.from_json(row[1], lambda x: None)
+                template_name = json.loads(row[1])['matriarch']['template_name']
+                c.execute("UPDATE " + table + " SET name = ?, template = ?, state = ?, moab_state = ?, hostname = ? WHERE id = ?",
+                          [job.get_name(), template_name, job.get_state(),
+                           MOABJob.get_state(job), job.info.get('hostname'), row[0]])
+
+    def __schema_row_versions(self, c):
+        # bumped on every write, so cached jobs can tell whether their row changed. Existing rows only need to be told
+        # apart from each other: a job can be in both tables at once, so they get different versions.
+        c.execute("ALTER TABLE job ADD COLUMN version INTEGER")
+        c.execute("ALTER TABLE run ADD COLUMN version INTEGER")
+        c.execute("UPDATE job SET version = 1")
+        c.execute("UPDATE run SET version = 2")
+
+    def __schema_completion_time(self, c):
+        # when each job finished, so the ones old enough to archive can be found without parsing the data blob
+        c.execute("ALTER TABLE job ADD COLUMN completed INTEGER")
+        c.execute("CREATE INDEX job_completed ON job (completed)")
+
+        for row in c.connection.cursor().execute("SELECT id, data FROM job"):
+            job = MatriarchJob.from_json(row[1], lambda x: None)
+            c.execute("UPDATE job SET completed = ? WHERE id = ?", [self.__completion_time(job), row[0]])
+
+    def __schema_data_format(self, c):
+        # rows written before compression existed hold plain JSON
+        c.execute("ALTER TABLE job ADD COLUMN data_format INTEGER DEFAULT " + str(DATA_JSON))
+        c.execute("ALTER TABLE run ADD COLUMN data_format INTEGER DEFAULT " + str(DATA_JSON))
+
+    def __schema_run_data_hash(self, c):
+        # a digest of the JSON in run.data, so a check that changed nothing but last_checked can skip rewriting it.
+        # Existing rows have none and get rewritten in full the next time they are checked.
+        c.execute("ALTER TABLE run ADD COLUMN data_hash TEXT")
+
+    def __schema_job_data_hash(self, c):
+        # the same for the job table, so writing a job that is already stored as it is can be skipped
+        c.execute("ALTER TABLE job ADD COLUMN data_hash TEXT")
+
+    def __schema_aggregate_table(self, c):
+        # running statistics (Welford's count, mean and sum of squared deviations) of each metric for every
+        # configuration a template has been run with. See __aggregate.
+        c.execute("CREATE TABLE aggregate (template TEXT, tag TEXT, revision_offset, config TEXT, metric TEXT, count INTEGER, mean REAL, m2 REAL, min REAL, max REAL, PRIMARY KEY (template, tag, revision_offset, config, metric))")
+
+        # fill it in from the jobs that are already stored
+        tables = ["job"]
+        if self.archivePath:
+            tables.append("archive.job")
+        for table in tables:
+            for row in c.connection.cursor().execute("SELECT template, data, " + ("data_format" if table == "job" else str(DATA_ZLIB)) + " FROM " + table):
+                self.__aggregate(c, row[0], MatriarchJob.from_json(self.__unpack(row[1], row[2]), self.tlf))
+
+    def __schema_job_aggregated(self, c):
+        # what __aggregate counted for each job, so deleting the job takes out exactly that even after the
+        # template's variables have changed. The statistics are rebuilt along with it so the two agree
+        c.execute("ALTER TABLE job ADD COLUMN aggregated TEXT")
+        c.execute("DELETE FROM aggregate")
+
+        tables = ["job"]
+        if self.archivePath:
+            tables.append("archive.job")
+        for table in tables:
+            for row in c.connection.cursor().execute("SELECT id, template, data, " + ("data_format" if table == "job" else str(DATA_ZLIB)) + " FROM " + table):
+                aggregated = self.__aggregate(c, row[1], MatriarchJob.from_json(self.__unpack(row[2], row[3]), self.tlf))
+                c.execute("UPDATE " + table + " SET aggregated = ? WHERE id = ?", [aggregated, row[0]])
+
+    def __pack(self, data):
+        """ returns the value to store in a data column for `data`, and the format it is stored in """
+        if self.compress_threshold is None or len(data) <= self.compress_threshold:
+            return data, DATA_JSON
+        # the fastest level: runs are rewritten on every check, and JSON shrinks well even at level 1
+        return sqlite3.Binary(zlib.compress(data.encode('utf-8'), 1)), DATA_ZLIB
+
+    def __unpack(self, data, data_format):
+        if data_format == DATA_ZLIB:
+            return zlib.decompress(bytes(data)).decode('utf-8')
+        return data
 
-            try: 
-                db.cursor().execute("SELECT * FROM run;")
-            except:
-                db.cursor().execute("CREATE TABLE run (id INTEGER PRIMARY KEY, machine TEXT, state INTEGER, data TEXT, last_checked INTEGER);")
-            
+    def __aggregate(self, c, template, job):
+        """ adds a completed job's DURATION and numeric results to the running statistics of its configuration. A
+        configuration is the job's regression_tag and offset (see reports/regression_gen.py) together with the values
+        it was given for the template's variables. Returns what was counted, as JSON to keep in the job's aggregated
+        column for __unaggregate, or None if the job doesn't count """
+        if not job.is_complete() or job.has_error():
+            return None
+
+        params = job.get_params()
+        keyed = ['NAME', 'regression_tag', 'offset']
+        variables = getattr(job.template, 'variables', None) or set()
+        config = dict((k, v) for k, v in params.items() if k.upper() in variables and k not in keyed)
+
+        metrics = {'DURATION': job.get_duration()}
+        for k, v in params.items():
+            v = self.__param_value(v)
+            if k not in config and k not in keyed and isinstance(v, numbers.Number) and not isinstance(v, bool):
+                metrics[k] = v
+
+        tag = params.get('regression_tag', "")
+        offset = self.__param_value(params.get('offset'))
+        key = [template, tag, "" if offset is None else offset, json.dumps(config, sort_keys=True)]
+        metrics = dict((metric, float(x)) for metric, x in metrics.items() if x is not None)
+
+        self.__apply_aggregate(c, key, metrics, 1)
+        return json.dumps([key, metrics])
+
+    def __unaggregate(self, c, aggregated):
+        """ takes what __aggregate counted for a job, as returned by it, back out of the running statistics. min and
+        max only ever widen: they can't be recovered once a job is taken back out """
+        if aggregated:
+            key, metrics = json.loads(aggregated)
+            self.__apply_aggregate(c, key, metrics, -1)
+
+    def __apply_aggregate(self, c, key, metrics, sign):
+        for metric, x in metrics.items():
+            row = c.execute("SELECT count, mean, m2, min, max FROM aggregate WHERE template = ? AND tag = ? AND revision_offset = ? AND config = ? AND metric = ?",
+                            key + [metric]).fetchone()
+            count, mean, m2, low, high = row if row else (0, 0.0, 0.0, x, x)
+
+            if sign > 0:
+                count += 1
+                delta = x - mean
+                mean += delta / count
+                m2 += delta * (x - mean)
+                low, high = min(low, x), max(high, x)
+            elif count <= 1:
+                c.execute("DELETE FROM aggregate WHERE template = ? AND tag = ? AND revision_offset = ? AND config = ? AND metric = ?", key + [metric])
+                continue
+            else:
+                old_mean = mean
+                count -= 1
+                mean = (old_mean * (count + 1) - x) / count
+                m2 = max(0.0, m2 - (x - mean) * (x - old_mean))
+
+            c.execute("REPLACE INTO aggregate (template, tag, revision_offset, config, metric, count, mean, m2, min, max) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                      key + [metric, count, mean, m2, low, high])
+
+    def __completion_time(self, job):
+        try:
+            return int(job.get_completion_time())
+        except (ValueError, TypeError):
+            return None
+
+    def __attach_archive(self, db):
+        c = db.cursor()
+        c.execute("ATTACH DATABASE ? AS archive", [self.archivePath])
+        if self.maintenance:
+            self.__use_incremental_vacuum(db, "archive")
+        if self.readers:
+            c.execute("PRAGMA archive.journal_mode = WAL;")
+
+        # the job table minus the fields nothing filters on; data holds the zlib compressed JSON
+        c.execute("CREATE TABLE IF NOT EXISTS archive.job (id INTEGER PRIMARY KEY, template TEXT, name TEXT, state TEXT, moab_state TEXT, hostname TEXT, completed INTEGER, version INTEGER, data BLOB, aggregated TEXT)")
+        if "aggregated" not in [row[1] for row in c.execute("PRAGMA archive.table_info(job)")]:
+            c.execute("ALTER TABLE archive.job ADD COLUMN aggregated TEXT")
+        c.execute("CREATE TABLE IF NOT EXISTS archive.param (job_id INTEGER, key TEXT, value, PRIMARY KEY (job_id, key))")
+        c.execute("CREATE INDEX IF NOT EXISTS archive.job_template ON job (template)")
+        c.execute("CREATE INDEX IF NOT EXISTS archive.param_key_value ON param (key, value)")
+
+    def __use_incremental_vacuum(self, db, schema):
+        """ lets maintenance free pages a few at a time. This only takes effect before the first table is created;
+        an existing database keeps its mode until someone runs a full VACUUM on it """
+        c = db.cursor()
+        c.execute("PRAGMA " + schema + ".auto_vacuum = INCREMENTAL")
+        if c.execute("PRAGMA " + schema + ".auto_vacuum").fetchone()[0] != db_maintenance.AUTO_VACUUM_INCREMENTAL:
+            logging.info("%s database was created without incremental vacuum, so maintenance can't shrink it. "
+                         "Run VACUUM on it once, with Matriarch stopped, to change that", schema)
+
+    def __maintenance_due(self):
+        return self.maintenance != None and self.maintenance.is_due(self.lastActivity)
+
+    def __run_maintenance(self, db):
+        def busy():
+            with self.newData:
+                return self.exitEvent.is_set() or len(self.toWrite) != 0 or self.__queries_pending() != 0
+
+        try:
+            self.__timed("maintenance", self.maintenance.run, db, busy)
+        except sqlite3.Error as e:
+            logging.error("Error during database maintenance: %s", str(e))
+
+    def __archived_data(self, data, data_format):
+        # everything in the archive is compressed
+        if data_format == DATA_ZLIB:
+            return data
+        return sqlite3.Binary(zlib.compress(data.encode('utf-8')))
+
+    def __archive_due(self):
+        return self.archivePath != None and self.archive_after is not None and time.time() >= self.nextArchive
+
+    def __archive_jobs(self, db):
+        """ moves one batch of old jobs into the archive. A full batch means there are probably more, so the next one
+        is moved on the next pass of the DB loop, after whatever work has been queued in the meantime """
+        # param ids go in an IN list, which SQLite limits to 999 variables
+        chunk = min(self.batch_size, 500)
+        c = db.cursor()
+        rows = c.execute("SELECT id, template, name, state, moab_state, hostname, completed, version, aggregated, data, data_format FROM job WHERE completed < ? LIMIT ?",
+                         [int(time.time() - self.archive_after), chunk]).fetchall()
+
+        if len(rows) == chunk:
+            self.nextArchive = time.time()
+        else:
+            self.nextArchive = time.time() + self.archive_interval
+
+        if len(rows) == 0:
+            return
+
+        ids = [row[0] for row in rows]
+        marks = ", ".join("?" * len(ids))
+        try:
+            c.execute("BEGIN")
+            c.executemany("REPLACE INTO archive.job (id, template, name, state, moab_state, hostname, completed, version, aggregated, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          [list(row[:-2]) + [self.__archived_data(row[-2], row[-1])] for row in rows])
+            c.execute("DELETE FROM archive.param WHERE job_id IN (" + marks + ")", ids)
+            c.execute("INSERT INTO archive.param (job_id, key, value) SELECT job_id, key, value FROM param WHERE job_id IN (" + marks + ")", ids)
+            c.execute("DELETE FROM param WHERE job_id IN (" + marks + ")", ids)
+            c.execute("DELETE FROM job WHERE id IN (" + marks + ")", ids)
+            self.__commit(c)
+            self.rowsArchived += len(rows)
+            self.lastActivity = time.time()
+            logging.info("Moved %d jobs to the archive", len(rows))
+        except sqlite3.Error as e:
+            logging.error("Error moving jobs to the archive: %s", str(e))
+            self.__rollback(c)
+            self.nextArchive = time.time() + self.archive_interval
+
+    def __param_value(self, value):
+        """ the value a parameter is stored (and compared) as: numbers and plain decimal strings become numbers, so
+        "1800" and 1800 match, other strings stay text, and anything that isn't a scalar is not stored. Numbers SQLite
+        can't hold (integers outside 64 bits, NaN and infinities) are stored as text """
+        if value is None or isinstance(value, (list, dict)):
+            return None
+
+        if isinstance(value, numbers.Number):
+            number = value
+        elif isinstance(value, basestring) and util.DECIMAL.match(value.strip()):
+            number = float(value)
+        else:
+            return value
+
+        if isinstance(number, float) and (math.isnan(number) or math.isinf(number)):
+            return "%s" % (value,)
+        if isinstance(number, float) and not number.is_integer():
+            return number
+        if INT64_MIN <= number <= INT64_MAX:
+            return int(number)
+        # too big for an INTEGER: a float stays a (REAL) float, anything else is kept as written
+        return number if isinstance(value, float) else "%s" % (value,)
+
+    def __sync_params(self, c, jobid, params):
+        c.execute("DELETE FROM param WHERE job_id = ?", [jobid])
+        rows = []
+        for k, v in params.items():
+            v = self.__param_value(v)
+            if v is not None:
+                rows.append([jobid, k, v])
+        c.executemany("INSERT INTO param (job_id, key, value) VALUES (?, ?, ?)", rows)
+
+    def __shut_down(self):
+        # nothing will serve the queues any more. Release everyone who is still waiting on them.
+        with self.newData:
+            self.closed = True
+            for kind, item, req in self.toWrite:
+                req.set_result(False)
+            for queue in self.toQuery:
+                for req in queue:
+                    req.set_result(None)
+                queue.clear()
+            self.toWrite.clear()
+            self.pendingWrites.clear()
+        self.ready.set()
+        with self.committed:
+            self.committed.notify_all()
+
+    def __queries_pending(self):
+        # called with newData held
+        return sum(len(queue) for queue in self.toQuery)
+
+    def __next_query(self):
+        """ takes the next query to serve off its queue: the oldest one that has waited past the starvation limit, or
+        else the oldest of the most urgent class. Called with newData held """
+        now = time.time()
+        starving = [queue[0] for queue in self.toQuery if len(queue) != 0 and now - queue[0].created >= self.starvation_limit]
+        if starving:
+            query = min(starving, key=lambda q: q.created)
+            return self.toQuery[query.priority].popleft()
+
+        for queue in self.toQuery:
+            if len(queue) != 0:
+                return queue.popleft()
+        return None
+
+    def __work_due(self):
+        # called with newData held
+        if self.exitEvent.is_set() or self.__queries_pending() != 0 or self.flushRequested or self.__archive_due():
+            return True
+
+        if self.__maintenance_due():
+            return True
+
+        if len(self.toWrite) >= self.batch_size:
+            return True
+
+        return len(self.toWrite) != 0 and time.time() - self.firstPending >= self.flush_deadline
+
+    def __time_to_deadline(self):
+        # called with newData held
+        wait = None
+        if len(self.toWrite) != 0:
+            wait = max(0.0, self.flush_deadline - (time.time() - self.firstPending))
+
+        if self.archivePath != None and self.archive_after is not None:
+            untilArchive = max(0.0, self.nextArchive - time.time())
+            wait = untilArchive if wait is None else min(wait, untilArchive)
+
+        untilMaintenance = self.maintenance.wake_time(self.lastActivity) if self.maintenance else None
+        if untilMaintenance is not None:
+            wait = untilMaintenance if wait is None else min(wait, untilMaintenance)
+
+        return wait
+
+    def __write_batch(self, db, batch):
+        # a writer may return something for the request to hand back, like the ids of inserted rows
+        writers = {'job': self.__write_job, 'run': self.__write_run, 'prerun': self.__write_prerun,
+                   'preruns': self.__write_preruns, 'global': self.__write_global,
+                   'unaggregate': self.__write_unaggregate}
+        c = db.cursor()
+        try:
+            c.execute("BEGIN")
+            results = [self.__timed("write " + kind, writers[kind], c, item) for kind, item, req in batch]
+            self.__commit(c)
+            self.commits += 1
+            self.rowsWritten += len(batch)
+            for (kind, item, req), result in zip(batch, results):
+                req.set_result(True if result is None else result)
+            self.__after_commit(batch)
+            return
+        except (sqlite3.Error, OverflowError, ValueError) as e:
+            # OverflowError and ValueError come from values the sqlite3 module can't bind
+            logging.error("Error committing a batch of %d writes, retrying them one at a time: %s", len(batch), str(e))
+            self.__rollback(c)
+
+        # something in the batch was bad. Commit the rows individually so only the offending ones are lost.
+        for kind, item, req in batch:
             try:
-                db.cursor().execute("SELECT * FROM prerun")
-            except:
-                db.cursor().execute("CREATE TABLE prerun (id INTEGER PRIMARY KEY AUTOINCREMENT, machine TEXT, name TEXT, template TEXT, data TEXT, depends TEXT, last_checked INTEGER)")
+                c.execute("BEGIN")
+                result = self.__timed("write " + kind, writers[kind], c, item)
+                self.__commit(c)
+                self.commits += 1
+                self.rowsWritten += 1
+                req.set_result(True if result is None else result)
+                self.__after_commit([(kind, item, req)])
+            except (sqlite3.Error, OverflowError, ValueError) as e:
+                logging.error("Dropping %s write: %s", kind, str(e))
+                self.__rollback(c)
+                req.set_error(e)
+
+    def __after_commit(self, batch):
+        if not self.columns:
+            return
 
+        # completed jobs go into their template's column cache
+        by_template = {}
+        for kind, item, req in batch:
+            if kind != 'job':
+                continue
+            row = self.__column_row(item)
+            if row:
+                by_template.setdefault(item.get_template_name(), []).append(row)
+
+        for template, rows in by_template.items():
             try:
-                db.cursor().execute("SELECT * FROM globals")
-            except:
-                db.cursor().execute("CREATE TABLE globals (key TEXT PRIMARY KEY, value TEXT)")
-
-            while True:
-                if self.exitEvent.is_set():
-                    return;
-
-                with self.newData as locked:
-                    while len(self.toInsert) == 0 and len(self.toQuery) == 0:
-                        self.newData.wait(0.5)
-                        if self.exitEvent.is_set():
-                            return;
-
-                    self.__check_for_inserts(db)
-                    self.__check_for_inserts_runs(db)
-                    self.__check_for_inserts_prerun(db)
-                    self.__check_for_inserts_globals(db)
-                    self.__check_for_queries(db)
-
-    def __check_for_inserts_globals(self, db):
-        if len(self.toInsertGlobals) != 0:
-            c = db.cursor()
-            glob = self.toInsertGlobals.pop(0)
-            c.execute("REPLACE INTO globals (key, value) VALUES(?, ?)", [glob[0], glob[1]])
-            db.commit()
-
-    def __check_for_inserts_runs(self, db):
-        if len(self.toInsertRuns) != 0:
-            c = db.cursor()
-            run = self.toInsertRuns.pop(0)
-            c.execute("REPLACE INTO run (id, state, machine, data, last_checked) VALUES(?, ?, ?, ?, ?);", 
-                      [run.get_id(), run.get_state(),
-                       self.machine, run.json(), int(time.time())])
-            db.commit()
-
-    def __check_for_inserts_prerun(self, db):
-        if len(self.toInsertPreruns) != 0:
-            c = db.cursor()
-            run = self.toInsertPreruns.pop(0)
-            if 'id' not in run:
-                c.execute("INSERT INTO prerun (machine, name, template, data, depends, last_checked) VALUES(?, ?, ?, ?, ?, ?);",
-                          [run['machine'], run['name'], run['template'], json.dumps(run['data']), json.dumps(run['depends']), int(time.time())])
-            else:
-                c.execute("REPLACE INTO prerun (id, machine, name, template, data, depends, last_checked) VALUES(?, ?, ?, ?, ?, ?, ?);",
-                          [run['id'], run['machine'], run['name'], run['template'], json.dumps(run['data']), json.dumps(run['depends']), int(time.time())])
+                self.columns.append(template, rows)
+            except Exception as e:
+                logging.error("Error updating the column cache for %s, it will be rebuilt: %s", template, str(e))
+                self.columns.invalidate(template)
 
-            db.commit()
+    def __column_row(self, job):
+        # the same jobs /api/data reports: complete and without errors
+        if not job.is_complete() or job.has_error():
+            return None
+        return (job.get_id(), job.get_duration(), job.get_params())
 
+    def __timed(self, label, func, *args):
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.metrics.record_statement(label, time.time() - start)
 
-    def __check_for_inserts(self, db):
-        if len(self.toInsert) != 0:
-            # data is available!
-            c = db.cursor()
-            job = self.toInsert.pop(0)
-            c.execute("INSERT INTO job (id, template, data) VALUES (?, ?, ?);", [job.get_id(), job.get_template_name(), job.json()])
-            db.commit()
+    def __commit(self, c):
+        start = time.time()
+        c.execute("COMMIT")
+        self.metrics.record_commit(time.time() - start)
 
-    def __check_for_queries(self, db):
-        if len(self.toQuery) != 0:
-            # need to perform query
-            c = db.cursor()
-            q = self.toQuery.pop(0)
+    def __rollback(self, c):
+        try:
+            c.execute("ROLLBACK")
+        except sqlite3.Error:
+            # the failed statement already ended the transaction
+            pass
+
+    def __write_global(self, c, glob):
+        c.execute("REPLACE INTO globals (key, value) VALUES(?, ?)", [glob[0], glob[1]])
+
+    def __next_version(self):
+        # only called from the DB thread
+        self.rowVersion += 1
+        return self.rowVersion
+
+    def __data_hash(self, payload):
+        # over the payload with its keys in order, less VOLATILE_FIELDS, so it only changes when the job does
+        data = json.loads(payload)
+        status = data.get('moab', data)
+        for field in VOLATILE_FIELDS:
+            status.pop(field, None)
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def __write_run(self, c, run):
+        payload = run.json()
+        data_hash = self.__data_hash(payload)
+        now = int(time.time())
+
+        # most checks find a job just as it was last time, so only its status columns need to change (or nothing at
+        # all, if it was already written this second). Everything else in the row is derived from the payload.
+        stored = c.execute("SELECT data_hash, last_checked, machine FROM run WHERE id = ?;", [run.get_id()]).fetchone()
+        if stored and stored[0] == data_hash:
+            if stored[1] == now and stored[2] == self.machine:
+                self.skipped += 1
+                return
 
-            c.execute(q['sql'], q['values'])
-            results = c.fetchall()
-            db.commit()
+            c.execute("UPDATE run SET last_checked = ?, machine = ? WHERE id = ?;", [now, self.machine, run.get_id()])
+            self.statusUpdates += 1
+            return
 
-            with self.cqLock:
-                self.completeQueries[q['key']] = results
-                self.cqLock.notify()
+        data, data_format = self.__pack(payload)
+        c.execute("REPLACE INTO run (id, state, machine, data, last_checked, name, template, moab_state, hostname, version, data_format, data_hash) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", 
+                  [run.get_id(), run.get_state(),
+                   self.machine, data, now,
+                   run.get_name(), run.get_template_name(), MOABJob.get_state(run), run.info.get('hostname'),
+                   self.__next_version(), data_format, data_hash])
+        self.__sync_params(c, run.get_id(), run.get_params())
+
+    def __write_prerun(self, c, run):
+        if 'id' not in run:
+            c.execute("INSERT INTO prerun (machine, name, template, data, depends, last_checked) VALUES(?, ?, ?, ?, ?, ?);",
+                      [run['machine'], run['name'], run['template'], json.dumps(run['data']), json.dumps(run['depends']), int(time.time())])
+            return c.lastrowid
+        else:
+            c.execute("REPLACE INTO prerun (id, machine, name, template, data, depends, last_checked) VALUES(?, ?, ?, ?, ?, ?, ?);",
+                      [run['id'], run['machine'], run['name'], run['template'], json.dumps(run['data']), json.dumps(run['depends']), int(time.time())])
+            return run['id']
+
+    def __write_unaggregate(self, c, jobid):
+        row = self.__stored_aggregated(c, jobid)
+        if row:
+            self.__unaggregate(c, row[0])
+
+    def __stored_aggregated(self, c, jobid):
+        # a job lives in one of the two tables; the row is None if it is in neither
+        row = c.execute("SELECT aggregated FROM job WHERE id = ?", [jobid]).fetchone()
+        if row == None and self.archivePath:
+            row = c.execute("SELECT aggregated FROM archive.job WHERE id = ?", [jobid]).fetchone()
+        return row
+
+    def __write_preruns(self, c, runs):
+        return [self.__write_prerun(c, run) for run in runs]
+
+    def __write_job(self, c, job):
+        payload = job.json()
+        data_hash = self.__data_hash(payload)
+
+        stored = c.execute("SELECT data_hash, aggregated FROM job WHERE id = ?;", [job.get_id()]).fetchone()
+        if stored and stored[0] == data_hash:
+            self.skipped += 1
+            return
 
+        # a job is counted once, when it first arrives. One written back from the archive already was
+        if stored:
+            aggregated = stored[1]
+        else:
+            archived = self.__stored_aggregated(c, job.get_id())
+            if archived:
+                aggregated = archived[0]
+            else:
+                aggregated = self.__aggregate(c, job.get_template_name(), job)
 
-    def __do_query(self, query, values):
-        with self.qcLock:
-            qid = self.q_count
-            self.q_count += 1
+        data, data_format = self.__pack(payload)
+        c.execute("REPLACE INTO job (id, template, data, name, state, moab_state, hostname, version, completed, data_format, data_hash, aggregated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                  [job.get_id(), job.get_template_name(), data,
+                   job.get_name(), job.get_state(), MOABJob.get_state(job), job.info.get('hostname'),
+                   self.__next_version(), self.__completion_time(job), data_format, data_hash, aggregated])
+        self.__sync_params(c, job.get_id(), job.get_params())
+
+    def __run_query(self, db, q):
+        if q.is_cancelled():
+            return
 
+        # need to perform query
+        c = db.cursor()
+        start = time.time()
+        try:
+            c.execute(q.sql, q.values)
+            q.set_result(c.fetchall())
+            self.metrics.record_statement(db_metrics.statement_label(q.sql), time.time() - start)
+        except sqlite3.Error as e:
+            logging.error("Error running query %s: %s", q.sql, str(e))
+            q.set_error(e)
+
+    def submit_query(self, query, values, priority=PRIORITY_INTERACTIVE):
+        """ queues a query for the DB thread and returns its DatabaseRequest without waiting for it """
+        req = DatabaseRequest(query, values, priority)
         with self.newData:
-            self.toQuery.append({'sql': query, 'values': values, 'key': qid})
+            if self.closed:
+                req.set_result(None)
+                return req
+            self.toQuery[priority].append(req)
             self.newData.notify()
+        return req
 
-        with self.cqLock:
-            while qid not in self.completeQueries:
-                if self.exitEvent.is_set():
-                    return None
+    def __do_query(self, query, values, timeout=None, priority=PRIORITY_MONITOR):
+        # deletes and flushes go through here, and the monitors are waiting on those
+        req = self.submit_query(query, values, priority)
+        if timeout is None:
+            timeout = self.query_timeout
 
-                self.cqLock.wait(1.0)
-            toR = self.completeQueries[qid]
-            del self.completeQueries[qid]
-            return toR
+        try:
+            return req.wait(timeout)
+        except DatabaseTimeout:
+            req.cancel()
+            logging.error("Query timed out after %s seconds: %s", str(timeout), query)
+            return None
 
-    def insert_run(self, job):
+    def __queue_write(self, kind, item, key=None):
+        """ queues a write for the DB thread. Writes with a `key` replace a queued write with the same key, so only
+        the newest of them is committed and every caller gets the same request back """
         with self.newData:
-            self.toInsertRuns.append(job)
+            if self.closed:
+                req = DatabaseRequest()
+                req.set_result(False)
+                return req
+
+            # still counted, so readers wait for the write that replaced this one
+            self.queuedSeq += 1
+
+            entry = self.pendingWrites.get(key) if key != None else None
+            if entry != None:
+                entry[1] = item
+                self.coalesced += 1
+                return entry[2]
+
+            if len(self.toWrite) == 0:
+                self.firstPending = time.time()
+            entry = [kind, item, DatabaseRequest()]
+            self.toWrite.append(entry)
+            if key != None:
+                self.pendingWrites[key] = entry
             self.newData.notify()
+        return entry[2]
 
-    def insert_prerun(self, prerun):
+    def __request_flush(self):
+        # ask the DB thread to commit everything queued so far without waiting out the flush deadline
         with self.newData:
-            self.toInsertPreruns.append(prerun)
-            self.newData.notify()
+            target = self.queuedSeq
+            if self.committedSeq < target:
+                self.flushRequested = True
+                self.newData.notify()
+        return target
+
+    def __wait_for_writes(self, timeout):
+        target = self.__request_flush()
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self.committed:
+            while self.committedSeq < target and not self.closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.committed.wait(remaining)
+        return True
 
-    def insert_job(self, job):
+    def __read(self, query, values, priority=PRIORITY_INTERACTIVE):
+        if not self.readers:
+            return self.__do_query(query, values, priority=priority)
+
+        queued = time.time()
+        if not self.ready.wait(self.query_timeout) or not self.__wait_for_writes(self.query_timeout):
+            logging.error("Timed out waiting for pending writes before query: %s", query)
+            return None
+
+        if self.closed or self.exitEvent.is_set():
+            return None
+
+        start = time.time()
+        rows = self.readers.run(query, values, priority)
+        self.metrics.record_statement(db_metrics.statement_label(query), time.time() - start)
+        # from the call, so waiting for earlier writes and for a connection both count
+        self.metrics.record_latency(PRIORITY_NAMES[priority], time.time() - queued)
+        return rows
+
+    def flush(self, timeout=None):
+        """ blocks until every write queued before the call has been committed """
+        self.__do_query("SELECT 1;", [], timeout=timeout)
+
+    def get_write_stats(self):
+        """ counts of rows committed and commits made, of writes that only updated a run's status columns, and of
+        writes avoided: merged with a newer queued write (coalesced) or already stored as they were (skipped) """
+        return {'rows': self.rowsWritten, 'commits': self.commits, 'status_updates': self.statusUpdates,
+                'coalesced': self.coalesced, 'skipped': self.skipped, 'archived': self.rowsArchived}
+
+    def add_run_listener(self, func):
+        """ `func` is called with every job passed to insert_run, once its write is queued """
+        self.runListeners.append(func)
+
+    def insert_run(self, job):
+        self.__invalidate_cached(job.get_id())
+        req = self.__queue_write('run', job, key=('run', job.get_id()))
+        for func in self.runListeners:
+            func(job)
+        return req
+
+    def insert_runs(self, jobs):
+        """ like insert_run for each of `jobs`, but queued all at once so the DB thread commits them together (in
+        transactions of up to batch_size rows). Returns the requests, in order """
         with self.newData:
-            self.toInsert.append(job)
-            self.newData.notify()
+            return [self.insert_run(job) for job in jobs]
+
+    def insert_prerun(self, prerun):
+        return self.__queue_write('prerun', prerun)
+
+    def insert_preruns_many(self, preruns):
+        """ inserts all of `preruns` in one transaction, so either every one of them is stored or none is. Blocks until
+        they are committed and returns their ids, in order. Returns None if the database is closed. Raises
+        DatabaseTimeout if the commit takes longer than the query timeout; the preruns are still committed later """
+        req = self.__queue_write('preruns', list(preruns))
+        self.__request_flush()
+        ids = req.wait(self.query_timeout)
+        return ids if isinstance(ids, list) else None
+
+    def insert_job(self, job):
+        self.__invalidate_cached(job.get_id())
+        return self.__queue_write('job', job, key=('job', job.get_id()))
 
     def insert_global(self, key, value):
+        return self.__queue_write('global', (key, value), key=('global', key))
+
+    def __invalidate_cached(self, jobid):
+        if self.jobCache:
+            self.jobCache.invalidate(jobid)
+
+    def get_aggregates(self, template, tag=None, metric=None):
+        """ the running statistics kept for each configuration `template` has been run with, optionally only for one
+        regression tag or one metric. Returns a list of dicts with the tag, revision offset, configuration (the values
+        of the template's variables), metric, count, mean, variance, min and max """
+        sql = "SELECT tag, revision_offset, config, metric, count, mean, m2, min, max FROM aggregate WHERE template = ?"
+        values = [template]
+        if tag is not None:
+            sql += " AND tag = ?"
+            values.append(tag)
+        if metric is not None:
+            sql += " AND metric = ?"
+            values.append(metric)
+
+        rows = self.__read(sql, values)
+        if rows == None:
+            return None
+
+        return [{'tag': r[0], 'offset': r[1], 'config': json.loads(r[2]), 'metric': r[3], 'count': r[4], 'mean': r[5],
+                 'variance': r[6] / (r[4] - 1) if r[4] > 1 else None, 'min': r[7], 'max': r[8]} for r in rows]
+
+    def get_maintenance_stats(self):
+        """ totals of what maintenance has reclaimed and checkpointed, and the report of its last run """
+        return self.maintenance.get_stats() if self.maintenance else None
+
+    def get_job_cache_stats(self):
+        return self.jobCache.get_stats() if self.jobCache else None
+
+    def get_metrics(self):
+        """ how busy the database is: the current and peak depth of the write queue and of the query queue for each
+        priority class, how long requests waited in them, the total latency of each class's queries, execution time
+        histograms for each statement (writes are labelled by kind), commit times, the write and job cache counters,
+        and what maintenance has done """
         with self.newData:
-            self.toInsertGlobals.append((key, value))
-            self.newData.notify()
+            depths = dict(zip(PRIORITY_NAMES, [len(queue) for queue in self.toQuery]))
+            depths['write'] = len(self.toWrite)
+        if self.readers:
+            # reads wait for a pooled connection instead
+            depths.update(self.readers.get_depths())
+
+        toR = self.metrics.get_stats(depths)
+        toR['writes'] = self.get_write_stats()
+        toR['job_cache'] = self.get_job_cache_stats()
+        toR['maintenance'] = self.get_maintenance_stats()
+        return toR
 
     def remove_run(self, job):
+        self.__invalidate_cached(job.get_id())
         self.__do_query("DELETE FROM run WHERE id = ?", [job.get_id()])
 
     def delete_job(self, jobid):
+        self.__invalidate_cached(jobid)
+        # committed before the deletes below run
+        self.__queue_write('unaggregate', jobid)
         self.__do_query("DELETE FROM run WHERE id = ?", [jobid])
         self.__do_query("DELETE FROM job WHERE id = ?", [jobid])
+        self.__do_query("DELETE FROM param WHERE job_id = ?", [jobid])
+        if self.archivePath:
+            self.__do_query("DELETE FROM archive.job WHERE id = ?", [jobid])
+            self.__do_query("DELETE FROM archive.param WHERE job_id = ?", [jobid])
+        if self.columns:
+            self.columns.invalidate()
 
     def delete_prerun(self, prerunid):
         self.__do_query("DELETE FROM prerun WHERE id = ?", [prerunid])
 
-    def get_jobs(self, limit=100):
-        jobs = self.__do_query("SELECT data FROM job ORDER BY id DESC LIMIT ?", [limit])
+    def __job_columns(self, table):
+        """ the columns __hydrate takes from `table`: id, version, data, data_format and the table's name. With the job
+        cache on, data is left out here and only read for the rows the cache misses """
+        if self.jobCache:
+            return "id, version, NULL, NULL, '" + table + "'"
+        data_format = str(DATA_ZLIB) if table.startswith("archive.") else "data_format"
+        return "id, version, data, " + data_format + ", '" + table + "'"
+
+    def __hydrate(self, rows, priority=PRIORITY_INTERACTIVE):
+        """ turns rows of __job_columns into new MatriarchJobs, reusing the parsed data of rows that have not changed.
+        Returns None if the data of a row the cache missed could not be read """
+        if not self.jobCache:
+            return [MatriarchJob.from_json(self.__unpack(row[2], row[3]), self.tlf) for row in rows]
+
+        found = {}
+        missed = collections.OrderedDict()
+        for jobid, version, data, data_format, table in rows:
+            cached = self.jobCache.get(jobid, version)
+            if cached != None:
+                found[jobid] = cached
+            else:
+                missed.setdefault(table, []).append(jobid)
+
+        # ids go in an IN list, which SQLite limits to 999 variables
+        for table, ids in missed.items():
+            columns = "id, version, data, " + (str(DATA_ZLIB) if table.startswith("archive.") else "data_format")
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                fetched = self.__read("SELECT " + columns + " FROM " + table + " WHERE id IN (" + ", ".join("?" * len(chunk)) + ");",
+                                      chunk, priority)
+                if fetched == None:
+                    return None
+                for jobid, version, data, data_format in fetched:
+                    found[jobid] = json.loads(self.__unpack(data, data_format))
+                    if version != None:
+                        self.jobCache.put(jobid, version, found[jobid])
+
+        # a row deleted in between is left out, as if it had already gone
+        return [MatriarchJob.from_data(copy_data(found[row[0]]), self.tlf) for row in rows if row[0] in found]
+
+    def get_jobs(self, limit=100, after_id=None, priority=PRIORITY_INTERACTIVE):
+        """ returns up to `limit` jobs, newest first. Pass the id of the last job of one page as `after_id` to get the
+        next (older) page """
+        if after_id is None:
+            jobs = self.__read("SELECT " + self.__job_columns("job") + " FROM job ORDER BY id DESC LIMIT ?", [limit], priority)
+        else:
+            jobs = self.__read("SELECT " + self.__job_columns("job") + " FROM job WHERE id < ? ORDER BY id DESC LIMIT ?", [after_id, limit], priority)
         if jobs == None:
             return None
-        jobs = map(lambda x: MatriarchJob.from_json(x[0], self.tlf), jobs)
-        return jobs
+        return self.__hydrate(jobs, priority)
 
-    def get_job_by_id(self, jobid):
-        job = self.__do_query("SELECT data FROM job WHERE id=?", [jobid])
+    def get_job_by_id(self, jobid, priority=PRIORITY_INTERACTIVE):
+        job = self.__read("SELECT " + self.__job_columns("job") + " FROM job WHERE id=?", [jobid], priority)
         if job == None or len(job) == 0:
             # maybe it is a run
-            job = self.__do_query("SELECT data FROM run WHERE id=?", [jobid])
+            job = self.__read("SELECT " + self.__job_columns("run") + " FROM run WHERE id=?", [jobid], priority)
 
-            if len(job) == 0:
-                return None
+            if (job == None or len(job) == 0) and self.archivePath:
+                # or it has been archived
+                job = self.__read("SELECT " + self.__job_columns("archive.job") + " FROM archive.job WHERE id=?", [jobid], priority)
 
-        job = MatriarchJob.from_json(job[0][0], self.tlf)
-        return job
+            if job == None or len(job) == 0:
+                return None
 
-    def get_jobs_for_template(self, template):
-        jobs = self.__do_query("SELECT data FROM job WHERE template=?", [template])
+        job = self.__hydrate(job, priority)
+        return job[0] if job else None
+
+    def __template_select(self, schema, template, params, after_id):
+        sql = "SELECT " + self.__job_columns(schema + "job") + " FROM " + schema + "job WHERE template=?"
+        values = [template]
+        for k, v in (params or {}).items():
+            sql += " AND id IN (SELECT job_id FROM " + schema + "param WHERE key=? AND value=?)"
+            values.extend([k, self.__param_value(v)])
+
+        if after_id is not None:
+            sql += " AND id > ?"
+            values.append(after_id)
+
+        return sql, values
+
+    def get_jobs_for_template(self, template, params=None, after_id=None, limit=None, include_archive=False,
+                              priority=None):
+        """ returns the completed jobs for a template, oldest first. If `params` is given, only jobs whose parameters
+        match every key and value in it are returned. With `limit`, at most that many jobs are returned; pass the id
+        of the last job of one page as `after_id` to get the next page. Archived jobs are only included with
+        `include_archive`. Unless a `priority` is given, a page is an interactive read and everything else is bulk """
+        if priority is None:
+            priority = PRIORITY_BULK if limit is None else PRIORITY_INTERACTIVE
+
+        sql, values = self.__template_select("", template, params, after_id)
+        if include_archive and self.archivePath:
+            archived, archivedValues = self.__template_select("archive.", template, params, after_id)
+            sql += " UNION ALL " + archived
+            values.extend(archivedValues)
+
+        sql += " ORDER BY id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            values.append(limit)
+
+        jobs = self.__read(sql, values, priority)
         if jobs == None:
             return None
-        jobs = map(lambda x: MatriarchJob.from_json(x[0], self.tlf), jobs)
-        return jobs
+        return self.__hydrate(jobs, priority)
+
+    def iter_jobs_for_template(self, template, params=None, after_id=None, page_size=500, include_archive=False):
+        """ yields the same jobs as get_jobs_for_template, fetching them a page at a time so only `page_size` of them
+        are held in memory at once. The DB thread is never tied up for longer than one page. Raises DatabaseTimeout if
+        a page can't be read in time, rather than ending early """
+        while True:
+            jobs = self.get_jobs_for_template(template, params=params, after_id=after_id, limit=page_size,
+                                              include_archive=include_archive, priority=PRIORITY_BULK)
+            if jobs == None:
+                raise DatabaseTimeout("Reading the jobs of " + template + " after " + str(after_id) + " timed out")
+            if not jobs:
+                return
+
+            for job in jobs:
+                yield job
+
+            if len(jobs) < page_size:
+                return
+            after_id = jobs[-1].get_id()
+
+    def get_column_cache(self, template):
+        """ returns the ColumnCache holding `template`'s completed jobs, building the template's columns from the
+        database first if needed. Returns None if the column cache is turned off or there is no such template """
+        if not self.columns or not self.tlf(template):
+            return None
+
+        if not self.columns.is_built(template):
+            jobs = self.iter_jobs_for_template(template, include_archive=True)
+            self.columns.build(template, (r for r in (self.__column_row(j) for j in jobs) if r))
+
+        return self.columns
 
     def get_runs(self):
-        jobs = self.__do_query("SELECT data FROM run;", [])
+        jobs = self.__read("SELECT " + self.__job_columns("run") + " FROM run;", [])
         if jobs == None:
             return None
-        jobs = map(lambda x: MatriarchJob.from_json(x[0], self.tlf), jobs)
-        return jobs
+        return self.__hydrate(jobs)
 
-    def get_last_incomplete_job(self):
-        curr_time = time.time()
-        job = self.__do_query("SELECT data FROM run WHERE state != 255 AND (? - last_checked > 20) AND machine = ? ORDER BY last_checked DESC LIMIT 1;", [curr_time, self.machine])
-        if job == None or len(job) == 0:
+    def get_job_summaries(self, limit=100, after_id=None, priority=PRIORITY_INTERACTIVE):
+        """ like get_jobs, but returns JobSummary objects """
+        if after_id is None:
+            rows = self.__read("SELECT id, name, template, state, moab_state, hostname FROM job ORDER BY id DESC LIMIT ?", [limit], priority)
+        else:
+            rows = self.__read("SELECT id, name, template, state, moab_state, hostname FROM job WHERE id < ? ORDER BY id DESC LIMIT ?", [after_id, limit], priority)
+        if rows == None:
             return None
-        job = MatriarchJob.from_json(job[0][0], self.tlf)
-        return job
+        return [JobSummary(*row) for row in rows]
+
+    def get_run_summaries(self, priority=PRIORITY_INTERACTIVE):
+        rows = self.__read("SELECT id, name, template, state, moab_state, hostname FROM run;", [], priority)
+        if rows == None:
+            return None
+        return [JobSummary(*row) for row in rows]
+
+    def get_runs_by_ids(self, ids):
+        """ the runs on this machine with the given ids. Ids that aren't in the run table are left out """
+        toR = []
+        # ids go in an IN list, which SQLite limits to 999 variables
+        for i in range(0, len(ids), 500):
+            chunk = list(ids[i:i + 500])
+            jobs = self.__read("SELECT " + self.__job_columns("run") + " FROM run WHERE machine = ? AND id IN (" + ", ".join("?" * len(chunk)) + ");", [self.machine] + chunk, PRIORITY_MONITOR)
+            if jobs == None:
+                return None
+            jobs = self.__hydrate(jobs, PRIORITY_MONITOR)
+            if jobs == None:
+                return None
+            toR.extend(jobs)
+        return toR
+
+    def get_run_schedule(self):
+        """ the id, MOAB state and last check time of every run on this machine """
+        return self.__read("SELECT id, moab_state, last_checked FROM run WHERE machine = ? AND state != 255;", [self.machine], PRIORITY_MONITOR)
 
     def get_prerun_by_name(self, name):
-        prerun = self.__do_query("SELECT id, template, data, depends from prerun WHERE name = ? LIMIT 1;", [name])
+        prerun = self.__read("SELECT id, template, data, depends from prerun WHERE name = ? LIMIT 1;", [name], PRIORITY_MONITOR)
         if prerun == None or len(prerun) == 0:
             return None
 
@@ -910,7 +2494,7 @@ class Database:
         return {'id': prerun[0], 'name': name, 'template': prerun[1], 'data': json.loads(prerun[2]), 'depends': json.loads(prerun[3])}
 
     def get_prerun(self):
-        prerun = self.__do_query("SELECT id, name, template, data, depends FROM prerun WHERE machine = ? AND (? - last_checked > 20) ORDER BY last_checked DESC LIMIT 1;", [self.machine, time.time()])
+        prerun = self.__read("SELECT id, name, template, data, depends FROM prerun WHERE machine = ? AND last_checked < ? ORDER BY last_checked DESC LIMIT 1;", [self.machine, time.time() - 20], PRIORITY_MONITOR)
 
         if prerun == None or len(prerun) == 0:
             return None
@@ -920,9 +2504,9 @@ class Database:
         return toR
 
     def get_global(self, key):
-        value = self.__do_query("SELECT value FROM globals WHERE key = ?;", [key])
+        value = self.__read("SELECT value FROM globals WHERE key = ?;", [key], PRIORITY_MONITOR)
         
-        if value == None or len(value) == None:
+        if value == None or len(value) == 0:
             return None
 
         return value[0][0]
@@ -45,6 +45,7 @@ import json
 import urllib
 import sys
 import datetime
+import math
 from scipy import stats
 import numpy as np
 import matplotlib as mpl
@@ -62,33 +63,50 @@ revisions_back = 7
 
 PERCENT = "\\%"
 
-req = urllib.urlopen(matriarch + "/api/data/" + template)
+class Summary:
+    """ count, mean, sum of squared deviations, min and max of the durations at one revision """
+    def __init__(self, count, mean, m2, low, high):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.low = low
+        self.high = high
+
+    def merge(self, other):
+        # Chan et al.'s way of combining two sets of running statistics
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        mean = self.mean + delta * other.count / count
+        m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        return Summary(count, mean, m2, min(self.low, other.low), max(self.high, other.high))
+
+    def std(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+
+# Matriarch keeps running statistics for every configuration, so only those are fetched instead of every job
+req = urllib.urlopen(matriarch + "/api/aggregates/" + template + "?" + urllib.urlencode({'regression_tag': tag, 'metric': "DURATION"}))
 j = json.loads(req.read())
 
 revs = {}
 
 for i in j:
-    if i['regression_tag'] != tag:
-        continue
-
-
-    if i['offset'] not in revs:
-        revs[i['offset']] = []
-
-    revs[i['offset']].append(i)
+    summary = Summary(i['count'], i['mean'], (i['variance'] or 0.0) * (i['count'] - 1), i['min'], i['max'])
+    revs[i['offset']] = revs[i['offset']].merge(summary) if i['offset'] in revs else summary
 
 
 relevant_revs = sorted(revs.keys(), reverse=True)[:revisions_back]
 relevant_points = list(map(lambda x: datetime.datetime.fromtimestamp(int(x)), relevant_revs))
 
 
-durations = list(map(lambda x: [y['DURATION'] for y in revs[x]], relevant_revs))
+durations = list(map(lambda x: revs[x], relevant_revs))
 
 
 def compare(durations, a, b):
-    conf = 1.0 - stats.ttest_ind(durations[a], durations[b])[1]
+    conf = 1.0 - stats.ttest_ind_from_stats(durations[a].mean, durations[a].std(), durations[a].count,
+                                            durations[b].mean, durations[b].std(), durations[b].count)[1]
     conf = "{:.1%}".format(conf).replace("%", PERCENT)
-    change = (np.mean(durations[b]) - np.mean(durations[a])) / np.mean(durations[a])
+    change = (durations[b].mean - durations[a].mean) / durations[a].mean
     change = "{:.1%}".format(change).replace("%", PERCENT)
     return (change, conf)
     
@@ -119,7 +137,7 @@ def interpret_conf(durations, a, b):
 
 
 def gen_r_val(dates, durations):
-    y = list(map(np.mean, durations))
+    y = list(map(lambda x: x.mean, durations))
     R = np.corrcoef(dates, y)[0][1]
     return ("Overall, the mean performance has an $R$ value of %s. This means that there is a %s %s correlation between time and performance. The code seems to be \\textbf{getting %s} over the examined time period. Approximately %s of the change in performance is explained by a linear model." %
             (wrap_num(round(R, 2)), "weak" if abs(R) < 0.5 else "strong", 
@@ -168,8 +186,8 @@ def gen_tbl(dates, durations):
 
 
 def generate_plot(x, y):
-    y_err = list(map(np.ptp, y))
-    y = list(map(np.mean, y))
+    y_err = list(map(lambda s: s.high - s.low, y))
+    y = list(map(lambda s: s.mean, y))
     
     plt.errorbar(x, y, yerr=y_err, xerr=0)
     plt.xticks(x, list(map(lambda x: datetime.datetime.fromtimestamp(x).strftime("%x"), x)))
@@ -206,7 +224,7 @@ print("\\section{Overview}")
 print(gen_r_val(relevant_revs, durations))
 print()
 
-print("The most recent test was performed on %s. The mean runtime was %s seconds, with a standard deviation of %s seconds. The previous test had mean runtime %s seconds with standard deviation %s seconds." % (relevant_points[0].strftime("%x"), wrap_num(np.mean(durations[0])), wrap_num(np.std(durations[0])), wrap_num(np.mean(durations[1])), wrap_num(np.std(durations[1]))))
+print("The most recent test was performed on %s. The mean runtime was %s seconds, with a standard deviation of %s seconds. The previous test had mean runtime %s seconds with standard deviation %s seconds." % (relevant_points[0].strftime("%x"), wrap_num(durations[0].mean), wrap_num(math.sqrt(durations[0].m2 / durations[0].count)), wrap_num(durations[1].mean), wrap_num(math.sqrt(durations[1].m2 / durations[1].count))))
 print()
 
 print("Figure~\\ref{fig:pot} shows a graph of changes in performance over time. Comparisons between the most recent test and the past %(cnt)s tests is given in section~\\ref{sec:bt}. Table~\\ref{tbl:comp} shows each of the %(cnt)s tests compared to each other." % {'cnt':wrap_num(revisions_back)})
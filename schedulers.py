@@ -0,0 +1,359 @@
+# Copyright (c) 2014, Los Alamos National Security, LLC
+# All rights reserved.
+# 
+# Copyright 2014. Los Alamos National Security, LLC. This software was 
+# produced under U.S. Government contract DE-AC52-06NA25396 for Los Alamos
+# National Laboratory (LANL), which is operated by Los Alamos National 
+# Security, LLC for the U.S. Department of Energy. The U.S. Government has 
+# rights to use, reproduce, and distribute this software.  NEITHER THE 
+# GOVERNMENT NOR LOS ALAMOS NATIONAL SECURITY, LLC MAKES ANY WARRANTY, EXPRESS
+# OR IMPLIED, OR ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If 
+# software is modified to produce derivative works, such modified software 
+# should be clearly marked, so as not to confuse it with the version available
+# from LANL.
+# 
+# Additionally, redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+# · Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# · Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# · Neither the name of Los Alamos National Security, LLC, Los Alamos National
+#   Laboratory, LANL, the U.S. Government, nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY LOS ALAMOS NATIONAL SECURITY, LLC AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOS ALAMOS NATIONAL 
+# SECURITY, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+
+""" adapters between Matriarch and the batch scheduler its jobs run under. Each one can look up the status of a job
+(or of many jobs at once), submit a job by running its template's deploy script, and cancel a job. Statuses are
+dicts with the attribute names and string values of MOAB's `checkjob --xml`, which is what MOABJob reads and what is
+stored in the database:
+
+    JobID, EState (Idle, Starting, Running, Completed or Removed), SubmissionTime, StartTime, CompletionTime (seconds
+    since the epoch), CompletionCode, User and ReqAWDuration (requested wall time, in seconds)
+
+Attributes a scheduler doesn't report are left out. """
+
+import re
+import time
+import heapq
+import collections
+import subprocess
+import threading
+import logging
+import xml.etree.ElementTree as ET
+
+from util import CommandTimeout
+
+# the most job ids passed to a single status command
+QUERY_BATCH = 100
+
+
+class SchedulerError(Exception):
+    pass
+
+
+class Scheduler:
+    """ the operations Matriarch needs from a batch scheduler. Commands are run through `start_command(args, kind)`,
+    which starts a command and returns a function that waits for its output (see matriarch.start_command) """
+    def __init__(self, start_command):
+        self.start_command = start_command
+
+    def run(self, args, kind):
+        try:
+            return self.start_command(args, kind)()
+        except (subprocess.CalledProcessError, CommandTimeout, OSError) as e:
+            raise SchedulerError("%s failed: %s" % (" ".join(args), str(e)))
+
+    def query(self, job_id):
+        """ the status of `job_id`, or None if the scheduler doesn't know it """
+        return self.query_many([job_id]).get(str(job_id))
+
+    def query_many(self, job_ids):
+        """ the statuses of every job in `job_ids` the scheduler knows about, by job id (as a string). Ids left out
+        have already been asked about on their own where a batched query couldn't say, so the scheduler doesn't know
+        them """
+        raise NotImplementedError
+
+    def submit(self, script, cwd=None):
+        """ runs the deploy script `script` (an argument list) and returns the id of the job it submitted, or None if
+        it didn't print one """
+        raise NotImplementedError
+
+    def cancel(self, job_id):
+        raise NotImplementedError
+
+
+class MOABScheduler(Scheduler):
+    """ MOAB, through checkjob and canceljob. Deploy scripts print the id msub gave them """
+    def query_many(self, job_ids):
+        chunks = [job_ids[i:i + QUERY_BATCH] for i in range(0, len(job_ids), QUERY_BATCH)]
+        # every batch is started before any is waited on, so they can run side by side
+        outputs = [self.start_command(["checkjob", "--xml"] + [str(j) for j in chunk], "checkjob") for chunk in chunks]
+
+        found = {}
+        for chunk, output in zip(chunks, outputs):
+            try:
+                root = ET.fromstring(output())
+            except (subprocess.CalledProcessError, CommandTimeout, OSError, ET.ParseError):
+                # checkjob rejects the whole batch if any id is unknown; those jobs are asked about one at a time
+                if len(chunk) > 1:
+                    for job_id in chunk:
+                        status = self.__query_one(job_id)
+                        if status is not None:
+                            found[str(job_id)] = status
+                continue
+            for entry in root.iter('job'):
+                found[entry.attrib.get('JobID')] = entry.attrib
+        return found
+
+    def __query_one(self, job_id):
+        try:
+            root = ET.fromstring(self.run(["checkjob", "--xml", str(job_id)], "checkjob"))
+        except (SchedulerError, ET.ParseError):
+            return None
+        return root[0].attrib if len(root) else None
+
+    def submit(self, script, cwd=None):
+        result = self.run(script, "deploy").strip()
+        try:
+            return int(result)
+        except ValueError:
+            logging.error("Expected the deployment script to return a job ID, instead got: %s", result)
+        return None
+
+    def cancel(self, job_id):
+        self.run(["canceljob", str(job_id)], "cancel")
+
+
+# Slurm job states, and the MOAB state each one is reported as. Jobs that ended any way but being cancelled count as
+# completed, with a nonzero CompletionCode unless they succeeded
+SLURM_STATES = {'PENDING': "Idle", 'REQUEUED': "Idle", 'REQUEUE_HOLD': "Idle", 'CONFIGURING': "Starting",
+                'RUNNING': "Running", 'COMPLETING': "Running", 'SUSPENDED': "Suspended", 'STOPPED': "Suspended",
+                'COMPLETED': "Completed", 'FAILED': "Completed", 'TIMEOUT': "Completed", 'NODE_FAIL': "Completed",
+                'OUT_OF_MEMORY': "Completed", 'BOOT_FAIL': "Completed", 'DEADLINE': "Completed",
+                'CANCELLED': "Removed", 'PREEMPTED': "Removed", 'REVOKED': "Removed"}
+
+
+def slurm_time(value):
+    """ seconds since the epoch for a Slurm timestamp, or None for one that isn't set (Unknown, None, N/A) """
+    try:
+        return str(int(time.mktime(time.strptime(value, "%Y-%m-%dT%H:%M:%S"))))
+    except ValueError:
+        return None
+
+
+def slurm_duration(value):
+    """ seconds in a Slurm time limit ([days-]hours:minutes:seconds, minutes:seconds or minutes), or None for
+    UNLIMITED and the like """
+    m = re.match(r"^(?:(\d+)-)?(\d+)(?::(\d+))?(?::(\d+))?$", value.strip())
+    if not m:
+        return None
+    days, a, b, c = [int(x) if x else None for x in m.groups()]
+    if c is not None:
+        seconds = a * 3600 + b * 60 + c
+    elif b is not None:
+        seconds = (a * 3600 + b * 60) if days is not None else (a * 60 + b)
+    else:
+        seconds = a * 3600 if days is not None else a * 60
+    return str(seconds + (days or 0) * 86400)
+
+
+class SlurmScheduler(Scheduler):
+    """ Slurm: squeue for jobs still in the queue, sacct for those that have left it, and scancel. Deploy scripts
+    print sbatch's output (or just the id, with --parsable) """
+    def __status(self, job_id, state, user, submitted=None, started=None, ended=None, limit=None, exit_code=None):
+        state = state.split()[0].rstrip("+") if state else ""
+        status = {'JobID': job_id, 'EState': SLURM_STATES.get(state, state.capitalize()), 'User': user}
+        for key, value in [('SubmissionTime', submitted and slurm_time(submitted)),
+                           ('StartTime', started and slurm_time(started)),
+                           ('CompletionTime', ended and slurm_time(ended)),
+                           ('ReqAWDuration', limit and slurm_duration(limit))]:
+            if value:
+                status[key] = value
+        if status['EState'] == "Completed":
+            code = int(exit_code.split(":")[0]) if exit_code else 0
+            if state != "COMPLETED" and code == 0:
+                code = 1
+            status['CompletionCode'] = str(code)
+        return status
+
+    def query_many(self, job_ids):
+        found = {}
+        for i in range(0, len(job_ids), QUERY_BATCH):
+            ids = ",".join(str(j) for j in job_ids[i:i + QUERY_BATCH])
+            try:
+                out = self.run(["squeue", "-h", "-j", ids, "-o", "%i|%T|%u|%V|%S|%l"], "checkjob")
+            except SchedulerError:
+                # older versions fail if any id has left the queue; sacct knows about those too
+                out = ""
+            for line in out.splitlines():
+                f = line.split("|")
+                if len(f) == 6:
+                    found[f[0]] = self.__status(f[0], f[1], f[2], f[3], f[4] if f[1] != "PENDING" else None, limit=f[5])
+
+        missing = [str(j) for j in job_ids if str(j) not in found]
+        for i in range(0, len(missing), QUERY_BATCH):
+            out = self.run(["sacct", "-n", "-P", "-X", "-j", ",".join(missing[i:i + QUERY_BATCH]),
+                            "--format=JobID,State,User,Submit,Start,End,Timelimit,ExitCode"], "checkjob")
+            for line in out.splitlines():
+                f = line.split("|")
+                if len(f) == 8:
+                    found[f[0]] = self.__status(*f)
+        return found
+
+    def submit(self, script, cwd=None):
+        result = self.run(script, "deploy").strip()
+        m = re.search(r"(\d+)(;\S*)?$", result)
+        if not m:
+            logging.error("Expected the deployment script to print a Slurm job ID, instead got: %s", result)
+            return None
+        return int(m.group(1))
+
+    def cancel(self, job_id):
+        self.run(["scancel", str(job_id)], "cancel")
+
+
+class FakeJob:
+    def __init__(self, job_id, args, cwd, runtime, submitted, eligible):
+        self.job_id = job_id
+        self.args = args
+        self.cwd = cwd
+        self.runtime = runtime
+        self.submitted = submitted
+        self.eligible = eligible
+        self.started = None
+        self.ended = None
+        self.code = None
+        self.proc = None
+        self.slot = None
+        self.cancelled = False
+
+
+class FakeScheduler(Scheduler):
+    """ a scheduler that lives in this process, for trying Matriarch out and benchmarking it without a cluster. It has
+    `slots` job slots, and a job becomes eligible to start `queue_delay` seconds after it is submitted, starting in
+    submission order as slots free up. With `runtime` set, jobs only pretend to run: each takes that many seconds
+    (or whatever `submit` is given) and succeeds. Otherwise the deploy script itself is run locally as the job, and its
+    exit status is the job's CompletionCode. Jobs are advanced whenever the scheduler is asked about them, so it needs
+    no thread of its own """
+    def __init__(self, start_command=None, slots=4, queue_delay=0.0, runtime=None, user="matriarch"):
+        Scheduler.__init__(self, start_command)
+        self.queue_delay = queue_delay
+        self.runtime = runtime
+        self.user = user
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.queue = collections.deque()
+        self.nextId = 1
+        # (time the slot is free from, slot). A slot held by a local process is free from infinity until it exits
+        self.slots = [(0.0, i) for i in range(max(1, int(slots)))]
+        heapq.heapify(self.slots)
+
+    def __advance(self, now):
+        # called with lock held
+        for job in self.jobs.values():
+            if job.proc and job.ended is None and job.proc.poll() is not None:
+                job.ended = now
+                job.code = job.proc.returncode
+                self.slots = [(now, i) if i == job.slot else (t, i) for t, i in self.slots]
+                heapq.heapify(self.slots)
+
+        while self.queue:
+            job = self.queue[0]
+            free, slot = self.slots[0]
+            start = max(free, job.eligible)
+            if start > now:
+                break
+            self.queue.popleft()
+            job.slot = slot
+            if job.args is None:
+                job.started = start
+                job.ended = start + job.runtime
+                job.code = 0
+                heapq.heapreplace(self.slots, (job.ended, slot))
+            else:
+                # a real process can't start in the past
+                job.started = now
+                job.proc = subprocess.Popen(job.args, cwd=job.cwd, close_fds=True)
+                heapq.heapreplace(self.slots, (float("inf"), slot))
+
+    def __status(self, job, now):
+        status = {'JobID': str(job.job_id), 'User': self.user, 'SubmissionTime': str(int(job.submitted))}
+        if job.runtime is not None:
+            status['ReqAWDuration'] = str(int(job.runtime) + 1)
+        if job.cancelled:
+            status['EState'] = "Removed"
+        elif job.started is None or job.started > now:
+            status['EState'] = "Idle"
+        elif job.ended is None or job.ended > now:
+            status['EState'] = "Running"
+        else:
+            status['EState'] = "Completed"
+            status['CompletionCode'] = str(job.code)
+        if job.started is not None and job.started <= now:
+            status['StartTime'] = str(int(job.started))
+        if job.ended is not None and job.ended <= now:
+            status['CompletionTime'] = str(int(job.ended))
+        return status
+
+    def query_many(self, job_ids):
+        now = time.time()
+        with self.lock:
+            self.__advance(now)
+            return dict((str(j), self.__status(self.jobs[int(j)], now)) for j in job_ids if int(j) in self.jobs)
+
+    def submit(self, script, cwd=None, runtime=None):
+        now = time.time()
+        with self.lock:
+            job_id = self.nextId
+            self.nextId += 1
+            if runtime is None:
+                runtime = self.runtime
+            job = FakeJob(job_id, None if runtime is not None else script, cwd, runtime, now, now + self.queue_delay)
+            self.jobs[job_id] = job
+            self.queue.append(job)
+            self.__advance(now)
+        return job_id
+
+    def cancel(self, job_id):
+        now = time.time()
+        with self.lock:
+            self.__advance(now)
+            job = self.jobs.get(int(job_id))
+            if job is None or (job.ended is not None and job.ended <= now):
+                return
+            job.cancelled = True
+            if job in self.queue:
+                self.queue.remove(job)
+            elif job.proc:
+                job.proc.kill()
+            else:
+                job.ended = now
+                self.slots = [(now, i) if i == job.slot else (t, i) for t, i in self.slots]
+                heapq.heapify(self.slots)
+
+
+SCHEDULERS = {'moab': MOABScheduler, 'slurm': SlurmScheduler, 'fake': FakeScheduler}
+
+
+def open_scheduler(options, start_command):
+    """ the scheduler described by the config's `scheduler` section: a `type` (moab, slurm or fake, defaulting to
+    moab) and any options for it """
+    options = dict(options or {})
+    kind = options.pop('type', "moab")
+    if kind not in SCHEDULERS:
+        raise ValueError("Unknown scheduler type " + repr(kind) + ", expected one of " + ", ".join(sorted(SCHEDULERS)))
+    return SCHEDULERS[kind](start_command, **options)
@@ -46,15 +46,25 @@ import httplib
 import sys
 
 def submit(requests):
+    # the whole batch goes in one request, and Matriarch commits it in one transaction
     for r in requests:
         print("Submitting", r['NAME'])
-        data = json.dumps(r)
-        headers = {'Content-Type': 'application/json'}
-        conn = httplib.HTTPConnection("localhost:8081")
-        conn.request("POST", "/api/submit", data, headers)
-        response = conn.getresponse()
-        response.read()
-        conn.close()
+    data = json.dumps(requests)
+    headers = {'Content-Type': 'application/json'}
+    conn = httplib.HTTPConnection("localhost:8081")
+    conn.request("POST", "/api/submit_batch", data, headers)
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+
+    if response.status == 202:
+        # queued, but Matriarch gave up waiting for the commit before it knew the ids
+        print(json.loads(body)['message'])
+        return None
+    if response.status != 200:
+        print("Submission failed:", response.status, response.reason)
+        return None
+    return json.loads(body)
 
 if __name__ == "__main__":
     with open(sys.argv[1]) as f:
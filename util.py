@@ -37,9 +37,47 @@
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import re
+import subprocess
+import threading
+
+# strings that are read as numbers, wherever job parameters are typed: plain decimals only, so hex revisions like
+# "1234e56" and words like "nan" stay text
+DECIMAL = re.compile(r"^[+-]?(\d+|\d+\.\d*|\.\d+)$")
+
 def first(func, itr):
     for i in itr:
         if func(i):
             return i
 
     return None
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+def run_command(args, cwd=None, timeout=None):
+    """ like subprocess.check_output, but kills the command and raises CommandTimeout if it runs for longer than
+    `timeout` seconds """
+    proc = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE)
+    timer = None
+    killed = []
+    if timeout is not None:
+        def kill():
+            killed.append(True)
+            proc.kill()
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+
+    try:
+        output = proc.communicate()[0]
+    finally:
+        if timer:
+            timer.cancel()
+
+    if killed:
+        raise CommandTimeout("%s did not finish within %s seconds" % (" ".join(args), str(timeout)))
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args, output=output)
+    return output